@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+## Benchmarks of chauffeur's own per-run overhead.
+##
+## Synthetic configurations are generated for each benchmark and the time
+## taken by the driver itself (not the executed commands) is measured.
+## Results are written as JSON so they can be compared between versions.
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+
+benchDir  = os.path.dirname(os.path.realpath(__file__))
+scriptDir = os.path.dirname(benchDir)
+sys.path.insert(0, scriptDir)
+
+import chauffeur
+
+# Problem sizes for the full and the --quick benchmark sets
+SIZES = {
+	'full':  {'nruns': [10**4, 10**5, 10**6], 'nvars': 6, 'templateKB': 256, 'exprDepth': 9,
+	          'nrender': 2000, 'templateFiles': 200, 'templateFileKB': 1024, 'ncopies': 20, 'e2eRuns': 2000},
+	'quick': {'nruns': [10**4], 'nvars': 4, 'templateKB': 16, 'exprDepth': 5,
+	          'nrender': 200, 'templateFiles': 20, 'templateFileKB': 64, 'ncopies': 5, 'e2eRuns': 100},
+}
+
+#============================================
+# configure: Reset chauffeur's global state and
+# load a configuration dictionary
+#============================================
+def configure(cfg):
+	"""Initialize chauffeur from a configuration dictionary"""
+
+	for d in (chauffeur.driverData, chauffeur.userData, chauffeur.runData, chauffeur.fileData, chauffeur.foldedData):
+		d.clear()
+	chauffeur.initDriverData(cfg)
+	chauffeur.initUserData(cfg)
+	chauffeur.initFileData(cfg)
+	chauffeur.initRunData(cfg)
+	chauffeur.foldParameters()
+	chauffeur.initRunSpaces()
+
+def timed(func, *args, **kwargs):
+	"""Call func and return (elapsed seconds, result)"""
+
+	tStart = time.perf_counter()
+	result = func(*args, **kwargs)
+	return time.perf_counter()-tStart, result
+
+#============================================
+# Synthetic configurations
+#============================================
+def sweepConfig(nruns, nvars):
+	"""Configuration with nvars variables whose product has roughly nruns runs"""
+
+	nvals = max(2, int(round(nruns**(1.0/nvars))))
+	variables = dict(('v{:d}'.format(i), list(range(nvals))) for i in range(nvars))
+	cfg = {'driver': {'rundir': '%(cwd)/run_'+'_'.join('%(v{:d})'.format(i) for i in range(nvars))},
+	       'userdef': {'scale': 2.5, 'offset': "`%(scale)*4`"},
+	       'run': {'variables': variables, 'parameters': {'label': 'case_%(v0:03d)'}}}
+	return cfg, nvals**nvars
+
+def templateText(nvars, sizeKB):
+	"""Parameterized text of roughly sizeKB kilobytes referencing all variables"""
+
+	line = ' '.join('v{0:d}=%(v{0:d})'.format(i) for i in range(nvars)) + ' offset=%(offset) label=%(label)\n'
+	return line * max(1, (sizeKB*1024)//len(line))
+
+def expressionChain(depth):
+	"""User parameters forming a chain of expressions depth levels deep"""
+
+	userdef = {'e0': "`%(v0)+1`"}
+	for i in range(1, depth):
+		userdef['e{:d}'.format(i)] = "`sqrt(%(e{:d})*%(e{:d}))+pow(%(v0),2)`".format(i-1, i-1)
+	return userdef
+
+#============================================
+# Benchmarks. Each returns a dict of results.
+#============================================
+def benchGenerateProduct(sizes):
+	"""Enumerate the run space with generateProduct and RunSpace"""
+
+	results = []
+	for nruns in sizes['nruns']:
+		cfg, n = sweepConfig(nruns, sizes['nvars'])
+		configure(cfg)
+		rdata = chauffeur.runData['run']
+
+		tProduct, _ = timed(lambda: sum(1 for _ in chauffeur.generateProduct(rdata['variables'], rdata['variableorder'])))
+		tIndices, _ = timed(lambda: sum(1 for _ in chauffeur.generateRuns()))
+		space = chauffeur.runSpaces['run']
+		nBuild = min(n, 10**5)
+		tBuild, _ = timed(lambda: [space.build(space.index(i)) for i in range(nBuild)])
+
+		results.append({'nruns': n,
+		                'generateProduct_s': tProduct,
+		                'generateRuns_s': tIndices,
+		                'build_per_run_us': 1e6*tBuild/nBuild})
+	return results
+
+def benchInterpolate(sizes):
+	"""Render a large template and short parameter strings"""
+
+	cfg, n = sweepConfig(sizes['nruns'][0], sizes['nvars'])
+	configure(cfg)
+	space = chauffeur.runSpaces['run']
+	runs = [space.build(space.index(i % n)) for i in range(sizes['nrender'])]
+
+	text = templateText(sizes['nvars'], sizes['templateKB'])
+	tTemplate, _ = timed(lambda: [chauffeur.interpolateString(text, d, chauffeur.fmtLong) for d in runs])
+	tRundir, _ = timed(lambda: [chauffeur.interpolateString(chauffeur.driverData['rundir'], d) for d in runs])
+
+	return {'template_kb': sizes['templateKB'],
+	        'template_per_run_ms': 1e3*tTemplate/len(runs),
+	        'template_mb_per_s': len(runs)*len(text)/tTemplate/2**20,
+	        'rundir_per_run_us': 1e6*tRundir/len(runs)}
+
+def benchEvaluate(sizes):
+	"""Evaluate a deep chain of dependent expressions"""
+
+	cfg, n = sweepConfig(sizes['nruns'][0], sizes['nvars'])
+	cfg['userdef'].update(expressionChain(sizes['exprDepth']))
+	configure(cfg)
+	space = chauffeur.runSpaces['run']
+	runs = [space.build(space.index(i % n)) for i in range(sizes['nrender'])]
+
+	last = '%(e{:d})'.format(sizes['exprDepth']-1)
+	tChain, _ = timed(lambda: [chauffeur.interpolateString(last, d) for d in runs])
+	tEval, _ = timed(lambda: [chauffeur.evaluateStr('`sqrt({0:d})*pow({0:d},2)+{0:d}/3`'.format(i % 97)) for i in range(len(runs))])
+
+	results = {'depth': sizes['exprDepth'],
+	           'chain_per_run_us': 1e6*tChain/len(runs),
+	           'evaluateStr_per_call_us': 1e6*tEval/len(runs)}
+
+	if(chauffeur.np is not None):
+		tVector, _ = timed(lambda: chauffeur.evaluateVectorized('`sqrt(%(v0))*pow(%(v1),2)`', runs))
+		tScalar, _ = timed(lambda: [chauffeur.evaluateStr(chauffeur.interpolateString('`sqrt(%(v0))*pow(%(v1),2)`', d)) for d in runs])
+		results['vectorized_per_run_us'] = 1e6*tVector/len(runs)
+		results['scalar_per_run_us'] = 1e6*tScalar/len(runs)
+	return results
+
+def benchProcessFile(sizes, workDir):
+	"""Render a file* section for many runs, then again with unchanged output"""
+
+	templatePath = os.path.join(workDir, 'bench.par_template')
+	with open(templatePath, 'w') as f:
+		f.write(templateText(sizes['nvars'], sizes['templateKB']))
+
+	cfg, n = sweepConfig(sizes['nruns'][0], sizes['nvars'])
+	cfg['file'] = {'input': templatePath, 'output': os.path.join(workDir, 'out', 'bench_%(v0)_%(v1).par')}
+	configure(cfg)
+	os.makedirs(os.path.join(workDir, 'out'))
+	space = chauffeur.runSpaces['run']
+	runs = [space.build(space.index(i % n)) for i in range(min(n, sizes['nrender']))]
+
+	tFirst, _ = timed(lambda: [chauffeur.processSingleFile('file', d) for d in runs])
+	tRepeat, _ = timed(lambda: [chauffeur.processSingleFile('file', d) for d in runs])
+
+	return {'template_kb': sizes['templateKB'],
+	        'first_per_file_ms': 1e3*tFirst/len(runs),
+	        'unchanged_per_file_ms': 1e3*tRepeat/len(runs)}
+
+def benchTemplateCopy(sizes, workDir):
+	"""Materialize a large template directory with each template mode"""
+
+	templateDir = os.path.join(workDir, 'template')
+	os.makedirs(os.path.join(templateDir, 'data'))
+	block = os.urandom(1024)
+	for i in range(sizes['templateFiles']):
+		with open(os.path.join(templateDir, 'data', 'f{:04d}.bin'.format(i)), 'wb') as f:
+			for _ in range(sizes['templateFileKB']):
+				f.write(block)
+
+	configure({'run': {'variables': {'a': [0]}}})
+	results = {'files': sizes['templateFiles'], 'file_kb': sizes['templateFileKB']}
+	for mode in chauffeur.TEMPLATE_MODES:
+		targets = [os.path.join(workDir, mode, str(i)) for i in range(sizes['ncopies'])]
+		tCopy, _ = timed(lambda: [chauffeur.materializeTemplate(templateDir, t, mode) for t in targets])
+		results[mode+'_per_dir_ms'] = 1e3*tCopy/len(targets)
+		shutil.rmtree(os.path.join(workDir, mode))
+	return results
+
+def benchEndToEnd(sizes, workDir):
+	"""Run chauffeur.py on a sweep of no-op commands, for each engine"""
+
+	results = dict()
+	for engine in ['threads', 'asyncio']:
+		cfg = {'driver': {'execcommand': 'true', 'rundir': workDir, 'engine': engine, 'nthreads': 8, 'nconcurrent': 64},
+		       'run': {'variables': {'n': list(range(sizes['e2eRuns']))}}}
+		inputFile = os.path.join(workDir, 'e2e_{}.yaml'.format(engine))
+		with open(inputFile, 'w') as f:
+			json.dump(cfg, f)
+
+		tRun, proc = timed(subprocess.run, [sys.executable, os.path.join(scriptDir, 'chauffeur.py'), '-i', inputFile],
+		                   cwd=workDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		results[engine] = {'runs': sizes['e2eRuns'], 'returncode': proc.returncode,
+		                   'elapsed_s': tRun, 'runs_per_s': sizes['e2eRuns']/tRun}
+	return results
+
+BENCHMARKS = [
+	('generateProduct', benchGenerateProduct, False),
+	('interpolateString', benchInterpolate, False),
+	('evaluateStr', benchEvaluate, False),
+	('processSingleFile', benchProcessFile, True),
+	('templateCopy', benchTemplateCopy, True),
+	('endToEnd', benchEndToEnd, True),
+]
+
+#============================================
+#                   MAIN
+#============================================
+if(__name__ == "__main__"):
+
+	parser = argparse.ArgumentParser(description='Benchmark the per-run overhead of chauffeur')
+	parser.add_argument('--quick', action='store_true', help='use small problem sizes')
+	parser.add_argument('-o', '--output', default=None, help='write JSON results to OUTPUT instead of stdout')
+	parser.add_argument('-b', '--bench', action='append', default=None,
+	                    choices=[b[0] for b in BENCHMARKS], help='only run the given benchmark(s)')
+	args = parser.parse_args()
+
+	sizes = SIZES['quick' if args.quick else 'full']
+	chauffeur.logger.setLevel('WARNING')
+
+	results = {'python': platform.python_version(),
+	           'platform': platform.platform(),
+	           'numpy': chauffeur.np is not None,
+	           'sizes': 'quick' if args.quick else 'full',
+	           'benchmarks': dict()}
+
+	for name, func, needsDir in BENCHMARKS:
+		if(args.bench and name not in args.bench):
+			continue
+		sys.stderr.write('Running {}\n'.format(name))
+		if(needsDir):
+			workDir = tempfile.mkdtemp(prefix='chauffeur_bench_')
+			try:
+				results['benchmarks'][name] = func(sizes, workDir)
+			finally:
+				shutil.rmtree(workDir)
+		else:
+			results['benchmarks'][name] = func(sizes)
+
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if(args.output is None):
+		sys.stdout.write(output+'\n')
+	else:
+		with open(args.output, 'w') as f:
+			f.write(output+'\n')
@@ -31,23 +31,192 @@ import subprocess
 import yaml
 import pyaml
 import itertools as it
-from collections import OrderedDict
+import functools
+from collections import OrderedDict, namedtuple
 import logging
+import logging.handlers
+import atexit
+import inspect
+import importlib
+import importlib.util
+import traceback
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
 import argparse
+import ast
+import asyncio
+import shlex
+import errno
+import hashlib
+import json
+import csv
+import re
+import sqlite3
+import fnmatch
+import tempfile
+import locale
+import heapq
+import random
+import socket
+import signal
+import bisect
+import socketserver
+from collections import deque
 
-from math import sqrt, pow
+# fcntl is only available on Unix, and is needed for reflink copies
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from math import sqrt, pow, ceil, log, exp
+
+# NumPy is optional, and used by the vectorized expression path (driver
+# parameter "vectorize") and to write .npz result tables
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 # Global configuration options
 driverData = dict()
 userData   = dict()
 runData    = OrderedDict()
 fileData   = OrderedDict()
+collectData = dict()
+runSpaces  = OrderedDict()
 fmtShort   = dict()
 fmtLong    = dict()
 
 pbsRundirs = []
 pbsFiles   = []
 
+# Completed runs, reported back to the main thread as they finish
+completions = queue.Queue()
+runSummary  = dict()
+
+# Failed runs (up to MAX_FAILED_REPORTS) with the tail of their captured
+# output, reported at the end of the sweep
+failedRuns = []
+MAX_FAILED_REPORTS = 10
+
+# Persistent run ledger (see RunLedger), if enabled
+ledger = None
+
+# Counts of generated files written and left unchanged
+fileStats     = {'written': 0, 'unchanged': 0}
+fileStatsLock = threading.Lock()
+
+# Per-run trace output and profile statistics (see RunTracer), if enabled
+tracer = None
+TRACE_VERSION = 1
+
+# Observed runtimes of previous sweeps (see RuntimeHistory), if enabled
+history = None
+
+# Content-addressed store of run outputs (see ResultCache), if enabled
+resultCache = None
+
+# Table of results parsed from the outputs of runs (see ResultCollector),
+# if a postcollect section is given
+collector = None
+COLLECT_FORMATS  = ['.csv', '.jsonl', '.npz']
+COLLECT_STATUSES = ['succeeded', 'cached', 'skipped']
+
+# Environment variables holding the index of a job array task, and the
+# matching variables holding the first index and number of tasks. PBS does
+# not export the range of an array, which is looked up with qstat instead
+SHARD_ENV = [('PBS_ARRAY_INDEX', None, None),
+             ('PBS_ARRAYID', None, None),
+             ('SLURM_ARRAY_TASK_ID', 'SLURM_ARRAY_TASK_MIN', 'SLURM_ARRAY_TASK_COUNT')]
+
+# Distributed execution: default coordinator host and the number of times a
+# run is handed out again after its worker disappeared before it is failed
+SERVE_HOST   = '127.0.0.1'
+MAX_REQUEUES = 3
+
+# Process umask, needed to give atomically written files default permissions
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Parameter delimiters and compiled template settings
+PARAM_BEG  = '%('
+PARAM_END  = ')'
+MAX_RECURS = 10
+TEMPLATE_CACHE_SIZE = 4096
+TEMPLATE_CACHE_MAXLEN = 4096
+
+# Expression evaluation settings. Expressions are evaluated against
+# a restricted namespace rather than the full set of builtins.
+EXPR_DELIM      = '`'
+EXPR_CACHE_SIZE = 1024
+exprNamespace   = {'__builtins__': {},
+                   'sqrt': sqrt, 'pow': pow,
+                   'abs': abs, 'min': min, 'max': max, 'round': round,
+                   'int': int, 'float': float}
+
+# Scopes used when folding parameters ahead of the sweep, from
+# widest to narrowest. Folded values are stored per run section
+# (None for global values) and per format context.
+SCOPE_GLOBAL  = 0
+SCOPE_SECTION = 1
+SCOPE_RUN     = 2
+SCOPE_DYNAMIC = 3
+foldedData    = dict()
+
+# Set while a value is folded, so that abort() raises FoldError instead of
+# exiting, and the value is left to be reported at run time
+folding = False
+
+# Number of pending runs held in the run queue per thread
+RUN_QUEUE_DEPTH = 4
+
+# Set when the feeder thread fails to queue all runs (see feedFailure)
+feedFailed = False
+
+# Stages of a run, each executed by its own pool of threads when the
+# 'pipeline' driver parameter is set (see Pipeline)
+PIPELINE_STAGES = ['setup', 'pre', 'exec', 'post']
+
+# Runs of run sections with 'depends_on' waiting for their upstream runs
+# (see RunDependencies), if any
+dependencies = None
+
+# Timeouts and speculative execution: seconds a process group is given to
+# exit after SIGTERM before it is killed, the number of completed runs
+# needed before stragglers are duplicated, the interval at which running
+# runs are checked, and the suffix of the directories of duplicates
+TIMEOUT_GRACE      = 5
+SPECULATE_MIN_RUNS = 5
+SPECULATE_INTERVAL = 1
+SPECULATE_SUFFIX   = '.speculative'
+speculator = None
+
+# Resource-aware scheduling: per-run resource keys of run sections (and their
+# defaults), the pool runs are scheduled on (see ResourcePool) and the number
+# of pending runs considered for backfilling
+RESOURCE_KEYS   = [('cores', 1), ('mem_gb', 0)]
+SCHEDULERS      = ['firstfit', 'backfill']
+BACKFILL_WINDOW = 32
+resourcePool     = None
+resourceWarnings = set()
+
+# Template directory materialization modes. FICLONE is the Linux ioctl
+# used to create copy-on-write clones of a file.
+TEMPLATE_MODES = ['copy', 'hardlink', 'reflink', 'symlink-readonly']
+FICLONE        = 0x40049409
+
+# Commands containing any of these characters are run through the shell,
+# all others are executed directly
+SHELL_CHARS = set('|&;<>()$`\\"\'*?[]#~={}!\n')
+
+# Commands starting with a shell builtin or keyword are also run through the shell
+SHELL_BUILTINS = set(['.', ':', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'eval', 'exec',
+                      'exit', 'export', 'fg', 'for', 'getopts', 'hash', 'if', 'jobs', 'read', 'readonly',
+                      'return', 'set', 'shift', 'source', 'times', 'trap', 'type', 'ulimit', 'umask',
+                      'unalias', 'unset', 'until', 'wait', 'while'])
+
 wetRun = True
 
 # Create logger and setup to go to stdout. This allows us
@@ -60,6 +229,10 @@ out_hdlr.setLevel(logging.INFO)
 logger.addHandler(out_hdlr)
 logger.setLevel(logging.INFO)
 
+# Background thread writing log records, once setupLogging has moved
+# logging off the calling threads
+logListener = None
+
 #============================================
 # abort: Helper function to abort execution
 #============================================
@@ -67,12 +240,66 @@ def abort(msg):
 	"""Abort execution and print critical log message"""
 	callerName = sys._getframe(1).f_code.co_name
 	output = '['+callerName+'] '+msg
+	if(folding):
+		raise FoldError(output)
 	logger.critical(output)
 	sys.exit(1)
 
-def logInfo(msg):
+class FoldError(Exception):
+	"""Raised by abort() for a value which fails to fold ahead of the sweep"""
+
+def logInfo(msg, *args, **kwargs):
 	"""Wrapper for the information-level logger"""
-	logger.info(msg)
+	logger.info(msg, *args, **kwargs)
+
+def logDebug(msg, *args, **kwargs):
+	"""Wrapper for the debug-level logger, used for per-run details"""
+	logger.debug(msg, *args, **kwargs)
+
+#============================================
+# setupLogging: Hand log records to a
+# QueueListener thread, so that threads
+# executing runs never wait on the console.
+# Records below the level given by verbosity
+# (-1: warnings, 0: progress, 1: per-run
+# details) are dropped before their message is
+# formatted. If eventsPath is given, records are
+# also written there as JSON objects, one per
+# line, with any structured fields passed as
+# extra={'fields': {...}}.
+#============================================
+class JsonFormatter(logging.Formatter):
+	"""Format log records as JSON event objects"""
+
+	def format(self, record):
+		event = OrderedDict([('time', record.created), ('level', record.levelname),
+		                     ('thread', record.threadName), ('message', record.getMessage())])
+		event.update(getattr(record, 'fields', {}))
+		return json.dumps(event, default=str)
+
+def setupLogging(verbosity=0, eventsPath=None):
+	"""Move log output onto a background thread at the requested verbosity"""
+
+	global logListener
+
+	consoleLevel = logging.WARNING if verbosity < 0 else (logging.INFO if verbosity == 0 else logging.DEBUG)
+	out_hdlr.setLevel(consoleLevel)
+	handlers = [out_hdlr]
+	level = consoleLevel
+	if(eventsPath is not None):
+		events_hdlr = logging.FileHandler(eventsPath, 'w')
+		events_hdlr.setFormatter(JsonFormatter())
+		events_hdlr.setLevel(min(consoleLevel, logging.INFO))
+		handlers.append(events_hdlr)
+		level = min(level, logging.INFO)
+
+	logQueue = queue.Queue()
+	logger.removeHandler(out_hdlr)
+	logger.addHandler(logging.handlers.QueueHandler(logQueue))
+	logger.setLevel(level)
+	logListener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+	logListener.start()
+	atexit.register(logListener.stop)
 
 #===============================================
 # resolveAbsPath: Convert paths to absolute
@@ -128,10 +355,38 @@ def initDriverData(cfg):
 	driverData['executable']    = None
 	driverData['rundir']        = '%(cwd)'
 	driverData['templatedir']   = None
+	driverData['templatemode']  = 'copy'
+	driverData['templatecopy']  = None
 	driverData['type']          = 'exec'
 	driverData['dryrun']        = True
 	driverData['skipifexist']   = True
+	driverData['ledger']        = None
+	driverData['history']       = None
+	driverData['cache']         = None
+	driverData['cachemb']       = 10240
+	driverData['outputs']       = None
+	driverData['stdout']        = None
+	driverData['stderr']        = None
+	driverData['tailkb']        = 4
+	driverData['pyworkers']     = None
+	driverData['pyrecycle']     = None
+	driverData['returnfile']    = None
+	driverData['templatecachemb'] = 64
 	driverData['nthreads']       = 1
+	driverData['engine']        = 'threads'
+	driverData['nconcurrent']   = 64
+	driverData['scheduler']     = None
+	driverData['maxcores']      = None
+	driverData['maxmem_gb']     = None
+	driverData['pinning']       = False
+	driverData['pretimeout']    = None
+	driverData['exectimeout']   = None
+	driverData['posttimeout']   = None
+	driverData['retries']       = 0
+	driverData['retrybackoff']  = 10
+	driverData['speculate']     = None
+	driverData['pipeline']      = None
+	driverData['vectorize']     = False
 
 	driverData['precommand']    = None
 	driverData['execcommand']   = None
@@ -140,6 +395,10 @@ def initDriverData(cfg):
 	# PBS stuff
 	driverData['pbs_submitscript'] = '%(cwd)/pbs_submit.sh'
 	driverData['pbs_subcommand']   = 'qsub'
+	driverData['pbs_mode']         = 'jobs'
+	driverData['pbs_pack']         = 1
+	driverData['pbs_jobdir']       = '%(cwd)/pbs_jobs'
+	driverData['pbs_arrayflag']    = '-J'
 
 	# Type formats
 	driverData['intFmtLong']   = 'd'
@@ -155,6 +414,49 @@ def initDriverData(cfg):
 				abort('Key "'+key+'" not accepted. Options are: '+', '.join(driverData.keys()))
 			driverData[key.lower()] = cfg[cfgKey][key]
 
+	templateCache.maxBytes = int(driverData['templatecachemb']*1024*1024)
+
+	if(driverData['templatemode'] not in TEMPLATE_MODES):
+		abort('Template mode "{}" not supported. Options are: {}'.format(driverData['templatemode'], ', '.join(TEMPLATE_MODES)))
+
+	if(driverData['engine'] not in ['threads','asyncio']):
+		abort('Engine "{}" not supported. Options are: threads, asyncio'.format(driverData['engine']))
+
+	if(driverData['pbs_mode'] not in ['jobs','array']):
+		abort('PBS mode "{}" not supported. Options are: jobs, array'.format(driverData['pbs_mode']))
+
+	if(driverData['scheduler'] is not None):
+		if(driverData['scheduler'] not in SCHEDULERS):
+			abort('Scheduler "{}" not supported. Options are: {}'.format(driverData['scheduler'], ', '.join(SCHEDULERS)))
+		if(driverData['engine'] != 'threads'):
+			abort('Scheduler "{}" requires the threads engine'.format(driverData['scheduler']))
+
+	if(driverData['type'] == 'python' and driverData['exectimeout'] is not None):
+		abort('exectimeout is not supported with type python')
+
+	if(driverData['cache'] is not None and not driverData['outputs']):
+		abort('The result cache requires the output files of a run (driver parameter "outputs")')
+
+	if(driverData['pipeline'] is not None):
+		for stage in driverData['pipeline']:
+			if(stage not in PIPELINE_STAGES):
+				abort('Pipeline stage "{}" not supported. Options are: {}'.format(stage, ', '.join(PIPELINE_STAGES)))
+			if(int(driverData['pipeline'][stage]) < 1):
+				abort('Pipeline stage "{}" needs at least one thread'.format(stage))
+		if(driverData['engine'] != 'threads' or driverData['scheduler'] is not None):
+			abort('Pipelined execution requires the threads engine without a scheduler')
+		if(driverData['speculate'] is not None):
+			abort('Speculative execution is not supported with a pipeline')
+
+	if(driverData['vectorize'] and np is None):
+		abort('Vectorized evaluation (driver parameter "vectorize") requires NumPy')
+
+	if(driverData['speculate'] is not None):
+		if(driverData['engine'] != 'threads'):
+			abort('Speculative execution requires the threads engine')
+		if(driverData['type'] == 'python'):
+			abort('Speculative execution is not supported with type python')
+
 	# Setup type -> format mappings
 	fmtLong[type(1)]    = driverData['intFmtLong']
 	fmtLong[type(1.0)]  = driverData['fltFmtLong']
@@ -202,9 +504,9 @@ def initRunData(cfg):
 		rdata = cfg[key]
 		varSet   = {v for v in rdata['variables']}
 
-		# Construct the variableorder field if necessary
+		# Construct the variableorder field if necessary (lexicographic order)
 		if('variableorder' not in rdata):
-			rdata['variableorder'] = list(varSet)
+			rdata['variableorder'] = sorted(varSet)
 		else:
 			# Confirm that all expected variable data is in the 'variableorder' field
 			if(not varSet == set(rdata['variableorder'])):
@@ -212,14 +514,57 @@ def initRunData(cfg):
 
 		# Ensure that all variable values are lists
 		# If they're not (e.g. a single int is the variable value),
-		# convert them to a single-element list
+		# convert them to a single-element list. Range strings
+		# (e.g. "linspace(0,1,100)") are expanded lazily by RunSpace.
 		for v in rdata['variables']:
-			if(type(rdata['variables'][v]) is not list):
+			if(type(rdata['variables'][v]) is not list and parseRange(rdata['variables'][v]) is None):
 				rdata['variables'][v] = [rdata['variables'][v]]
 
 		# Store run data
 		runData[key.lower()] = rdata
 
+	# Run sections may depend on others (see RunDependencies)
+	for key in runData:
+		dependsOn = runData[key].get('depends_on') or []
+		if(not isinstance(dependsOn, list)):
+			dependsOn = [dependsOn]
+		runData[key]['depends_on'] = [d.lower() for d in dependsOn]
+		for upstream in runData[key]['depends_on']:
+			if(upstream not in runData):
+				abort('Run section "{}" depends on unknown run section "{}"'.format(key, upstream))
+	if(any(runData[key]['depends_on'] for key in runData)):
+		cycle = dependencyCycle()
+		if(cycle is not None):
+			abort('Run sections depend on each other: {}'.format(' -> '.join(cycle)))
+		if(driverData['engine'] != 'threads' or driverData['scheduler'] is not None):
+			abort('depends_on requires the threads engine without a scheduler')
+
+#============================================
+# dependencyCycle: Find a cycle in the
+# depends_on graph of the run sections
+#============================================
+def dependencyCycle():
+	"""Return a list of run sections forming a dependency cycle, or None"""
+
+	visited = set()
+	def visit(section, path):
+		if(section in path):
+			return path[path.index(section):]+[section]
+		if(section in visited):
+			return None
+		visited.add(section)
+		for upstream in runData[section]['depends_on']:
+			cycle = visit(upstream, path+[section])
+			if(cycle is not None):
+				return cycle
+		return None
+
+	for section in runData:
+		cycle = visit(section, [])
+		if(cycle is not None):
+			return cycle
+	return None
+
 
 #============================================
 # initFileData: Initialize relevant data about
@@ -257,6 +602,73 @@ def initFileData(cfg):
 		# Store file data
 		fileData[key.lower()] = rdata
 
+#============================================
+# initCollectData: Initialize the collection of
+# per-run results (postcollect section)
+#============================================
+def initCollectData(cfg):
+	"""Extract 'postcollect' parameters from the YAML configuration"""
+
+	if('postcollect' not in cfg):
+		return
+
+	# Set defaults
+	collectData['output']   = '%(cwd)/results.csv'
+	collectData['nworkers'] = 8
+	collectData['columns']  = None
+	collectData['files']    = []
+
+	for k in cfg['postcollect']:
+		if(k.lower() not in collectData):
+			abort('Postcollect key "'+k+'" not accepted. Options are: '+', '.join(collectData.keys()))
+		collectData[k.lower()] = cfg['postcollect'][k]
+
+	if(os.path.splitext(collectData['output'])[1] not in COLLECT_FORMATS):
+		abort('Postcollect output must be one of: {}'.format(', '.join('*'+ext for ext in COLLECT_FORMATS)))
+	if(collectData['output'].endswith('.npz') and np is None):
+		abort('Postcollect output to .npz requires NumPy')
+
+	# Set defaults of each collected file and compile its parser
+	files = []
+	for cdata in collectData['files']:
+		spec = {'file': None, 'parser': None, 'pattern': None, 'path': None, 'sep': '=', 'row': -1}
+		for k in cdata:
+			if(k.lower() not in spec):
+				abort('Postcollect file key "'+k+'" not accepted. Options are: '+', '.join(spec.keys()))
+			spec[k.lower()] = cdata[k]
+		if(spec['file'] is None):
+			abort('Postcollect files need a "file" key')
+		if(spec['parser'] not in COLLECT_PARSERS):
+			abort('Postcollect parser "{}" not supported. Options are: {}'.format(spec['parser'], ', '.join(COLLECT_PARSERS)))
+		if(spec['parser'] == 'regex'):
+			if(spec['pattern'] is None):
+				abort('The regex parser of "{}" needs a "pattern"'.format(spec['file']))
+			spec['pattern'] = re.compile(spec['pattern'], re.MULTILINE)
+			if(not spec['pattern'].groupindex):
+				abort('The pattern of "{}" needs named groups, e.g. (?P<energy>\\S+)'.format(spec['file']))
+		if(spec['parser'] == 'json'):
+			if(spec['path'] is None):
+				abort('The json parser of "{}" needs a "path"'.format(spec['file']))
+			if(not isinstance(spec['path'], dict)):
+				spec['path'] = {str(spec['path']).split('.')[-1]: spec['path']}
+		files.append(spec)
+	collectData['files'] = files
+
+#============================================
+# RunInstance: Parameter data for a single run.
+# Behaves as a dict, but also records the run
+# section it was generated from so that values
+# folded for that section can be used.
+#============================================
+class RunInstance(dict):
+	"""Dictionary of run parameters tagged with its run section"""
+
+	__slots__ = ('section',)
+
+	def __init__(self, section, *args, **kwargs):
+		dict.__init__(self, *args, **kwargs)
+		self.section = section
+
 #============================================
 # generateProduct: Compute the cartesian product of
 # all variables in a given order. This assumes that
@@ -266,134 +678,458 @@ def initFileData(cfg):
 # itertools.product generates the cartesian product.
 #============================================
 def generateProduct(dicts,order):
-	"""Generate the Cartesian product of a dictionary of parameters"""
+	"""Lazily generate the Cartesian product of a dictionary of parameters"""
 
 	lists = []
 	for v in reversed(order):
 		lists.append(dicts[v])
-	return list(dict(zip(reversed(order), x)) for x in it.product(*lists))
-
+	return (dict(zip(reversed(order), x)) for x in it.product(*lists))
 
 #============================================
-# interpolateString: Recursively replace
-# parameters in a given string based on
-# driver, user, and [optional] input data
+# Lazy variable ranges. A variable may be given
+# as a "linspace(start, stop, num)" or
+# "range([start,] stop[, step])" string rather
+# than a list; its values are then computed on
+# demand instead of being stored.
 #============================================
-def interpolateString(inStr, inputData=None, inputFmt=None, nCalls=0):
-	"""Given an input string, replace all parameters and return the resolved string"""
+class Linspace(object):
+	"""Lazy sequence of num evenly spaced values from start to stop (inclusive)"""
 
-	# logInfo('[interpolateString] inStr: %s    nCalls: %d    type:%s'%(inStr,nCalls,type(inStr)))
+	def __init__(self, start, stop, num):
+		if(int(num) < 1):
+			raise ValueError('linspace requires at least one value')
+		self.start = start
+		self.stop  = stop
+		self.num   = int(num)
 
-	MAX_RECURS = 10
-	begStr = '%('
-	endStr = ')'
+	def __len__(self):
+		return self.num
 
-	if(inStr is None):
+	def __getitem__(self, i):
+		if(not 0 <= i < self.num):
+			raise IndexError('linspace index out of range')
+		if(self.num == 1):
+			return float(self.start)
+		return self.start + (self.stop-self.start)*i/float(self.num-1)
+
+	def __repr__(self):
+		return 'linspace({!r}, {!r}, {:d})'.format(self.start, self.stop, self.num)
+
+RANGE_FUNCS = {'linspace': Linspace, 'range': range}
+
+def parseRange(value):
+	"""Return the lazy sequence described by a range string, or None if value is not one"""
+
+	if(not isinstance(value,str)):
 		return None
+	name, sep, rest = value.strip().partition('(')
+	if(name not in RANGE_FUNCS or not rest.endswith(')')):
+		return None
+	try:
+		return RANGE_FUNCS[name](*ast.literal_eval('('+rest[:-1]+',)'))
+	except (ValueError, TypeError, SyntaxError) as e:
+		abort('Invalid range "{}": {}'.format(value, e))
 
-	if(not isinstance(inStr,str)):
-		return inStr
+def variableValues(value):
+	"""Return the values of a variable, expanding range strings lazily"""
 
-	outStr = inStr
+	values = parseRange(value)
+	return value if values is None else values
 
-	if(nCalls>=MAX_RECURS):
-		abort('Maximum number of recursions exceeded ({})'.format(MAX_RECURS))
+#============================================
+# Sampling: by default the runs of a section
+# are the full tensor product of its variables.
+# The 'sampling' key of a run section selects a
+# subset instead:
+#   product            - every combination
+#   zip                - the i-th values of all
+#                        variables together
+#   random: N          - N distinct combinations
+#                        drawn uniformly
+#   latin_hypercube: N - N combinations forming a
+#                        Latin hypercube over the
+#                        variables' values
+#   halton: N          - the first N points of the
+#                        Halton sequence, mapped
+#                        onto the variables' values
+# Samples are drawn with a fixed seed (given by
+# an optional 'seed' key), so every process
+# sharing a sweep enumerates the same runs.
+#============================================
+SAMPLINGS = ['product', 'zip', 'random', 'latin_hypercube', 'halton']
+
+def parseSampling(section, sampling):
+	"""Return the (method, number of runs, seed) of a sampling specification"""
+
+	if(sampling is None or isinstance(sampling,str)):
+		method, nRuns, seed = sampling or 'product', None, None
+	elif(isinstance(sampling,dict)):
+		methods = [key for key in sampling if key != 'seed']
+		if(len(methods) != 1):
+			abort('Sampling of run section "{}" must specify a single method'.format(section))
+		method, seed = methods[0], sampling.get('seed')
+		nRuns = int(sampling[method]) if sampling[method] is not None else None
+	else:
+		abort('Invalid sampling of run section "{}": {}'.format(section, sampling))
+
+	if(method not in SAMPLINGS):
+		abort('Sampling "{}" not supported. Options are: {}'.format(method, ', '.join(SAMPLINGS)))
+	if(method in ['random','latin_hypercube','halton'] and (nRuns is None or nRuns < 1)):
+		abort('Sampling "{}" of run section "{}" requires a number of runs'.format(method, section))
+	return method, nRuns, seed
+
+def sampleRandom(space, nRuns, seed):
+	"""Distinct combinations drawn uniformly from the tensor product"""
+
+	total = space.productSize()
+	rng = random.Random(seed or 0)
+	return [space.productIndex(n) for n in sorted(rng.sample(range(total), min(nRuns, total)))]
+
+def sampleLatinHypercube(space, nRuns, seed):
+	"""Latin hypercube of nRuns points, mapped onto the values of each variable"""
+
+	rng = random.Random(seed or 0)
+	columns = []
+	for size in space.sizes:
+		strata = list(range(nRuns))
+		rng.shuffle(strata)
+		columns.append([int(size*(k + rng.random())/nRuns) for k in strata])
+	return list(zip(*columns)) if columns else [()]
+
+def radicalInverse(n, base):
+	"""Van der Corput radical inverse of n in the given base"""
+
+	inverse, denom = 0.0, 1.0
+	while(n > 0):
+		n, digit = divmod(n, base)
+		denom *= base
+		inverse += digit/denom
+	return inverse
+
+def sampleHalton(space, nRuns, seed):
+	"""First nRuns points of the Halton sequence (randomly shifted if seeded)"""
+
+	primes = []
+	candidate = 2
+	while(len(primes) < len(space.sizes)):
+		if(all(candidate % p for p in primes)):
+			primes.append(candidate)
+		candidate += 1
+	shifts = [0.0]*len(primes)
+	if(seed is not None):
+		rng = random.Random(seed)
+		shifts = [rng.random() for _p in primes]
+
+	# The first point of the sequence (the origin) is skipped
+	samples = []
+	for n in range(1, nRuns+1):
+		samples.append(tuple(int(size*((radicalInverse(n, p)+shift) % 1.0))
+		                     for size, p, shift in zip(space.sizes, primes, shifts)))
+	return samples
+
+SAMPLERS = {'random': sampleRandom, 'latin_hypercube': sampleLatinHypercube, 'halton': sampleHalton}
+
+#============================================
+# RunSpace: Compact, lazy representation of the
+# runs defined by a single run* section. A run
+# is identified by an index tuple into the
+# per-variable value lists (ordered as in
+# variableorder, fastest varying first), and
+# its RunInstance is only built when needed.
+# Runs of the full product are enumerated in
+# the same order as generateProduct; sampled
+# runs are held as a list of index tuples.
+#============================================
+class RunSpace(object):
+	"""Mixed-radix index space over the variables of a run section"""
+
+	def __init__(self, section):
+		rdata = runData[section]
+		self.section    = section
+		self.order      = list(rdata['variableorder'])
+		self.values     = [variableValues(rdata['variables'][v]) for v in self.order]
+		self.sizes      = [len(v) for v in self.values]
+		self.parameters = rdata.get('parameters') or dict()
+
+		self.sampling, nRuns, seed = parseSampling(section, rdata.get('sampling'))
+		self.samples = None
+		if(self.sampling == 'zip' and len(set(self.sizes)) > 1):
+			abort('Variables of run section "{}" must have the same number of values to be zipped'.format(section))
+		if(self.sampling in SAMPLERS):
+			# Drop duplicates, which arise when variables have fewer values than runs
+			samples = SAMPLERS[self.sampling](self, nRuns, seed)
+			self.samples = list(OrderedDict.fromkeys(samples))
+			if(len(self.samples) < len(samples)):
+				logInfo('Run section "{}": {:d} of {:d} {} samples are distinct'.format(section, len(self.samples), len(samples), self.sampling))
+
+	def productSize(self):
+		"""Number of runs in the full tensor product of the variables"""
+		n = 1
+		for size in self.sizes:
+			n *= size
+		return n
+
+	def productIndex(self, n):
+		"""Return the index tuple of the n-th run of the full tensor product"""
+		idx = []
+		for size in self.sizes:
+			n, i = divmod(n, size)
+			idx.append(i)
+		return tuple(idx)
+
+	def __len__(self):
+		if(self.samples is not None):
+			return len(self.samples)
+		if(self.sampling == 'zip'):
+			return self.sizes[0] if self.sizes else 1
+		return self.productSize()
+
+	def indices(self):
+		"""Yield the index tuple of every run in the section"""
+		if(self.samples is not None):
+			for idx in self.samples:
+				yield idx
+		elif(self.sampling == 'zip'):
+			for i in range(len(self)):
+				yield (i,)*len(self.sizes)
+		else:
+			for idx in it.product(*[range(n) for n in reversed(self.sizes)]):
+				yield idx[::-1]
+
+	def index(self, n):
+		"""Return the index tuple of the n-th run in the section"""
+		if(self.samples is not None):
+			return self.samples[n]
+		if(self.sampling == 'zip'):
+			return (n,)*len(self.sizes)
+		return self.productIndex(n)
+
+	def build(self, idx):
+		"""Construct the RunInstance for an index tuple"""
+		data = RunInstance(self.section, zip(self.order, (vals[i] for vals, i in zip(self.values, idx))))
+		data.update(self.parameters)
+		return data
+
+#============================================
+# initConfig: Initialize all configuration data
+# from a parsed YAML configuration
+#============================================
+def initConfig(cfg):
+	"""Initialize driver, user, file and run data and the run spaces"""
+
+	# Initialize driver configuration
+	initDriverData(cfg)
+	# Initialize user configuration
+	initUserData(cfg)
+	# Initialize file configurations
+	initFileData(cfg)
+	# Initialize result collection
+	initCollectData(cfg)
+	# Initialize run configurations
+	initRunData(cfg)
+
+	# Resolve run-independent parameters once
+	foldParameters()
+
+	# Construct the (lazy) run space of each run section
+	initRunSpaces()
+
+#============================================
+# initRunSpaces: Construct the run space of
+# each run* section
+#============================================
+def initRunSpaces():
+	"""Create a RunSpace for every run section"""
+
+	runSpaces.clear()
+	for key in runData:
+		runSpaces[key] = RunSpace(key)
+		logInfo('Run section "{}" defines {:d} runs'.format(key, len(runSpaces[key])))
+
+#============================================
+# generateRuns: Stream (section, index tuple)
+# pairs for all runs, in section order
+#============================================
+def generateRuns():
+	"""Lazily yield a (section, index tuple) pair for every run"""
+
+	for space in runSpaces.values():
+		for idx in space.indices():
+			yield (space.section, idx)
+
+#============================================
+# compileTemplate: Parse a parameterized string
+# into a tuple of literal segments and
+# placeholders. The inline format of each
+# placeholder is split off here, so rendering
+# does not need to rescan the string. Results
+# for strings of up to TEMPLATE_CACHE_MAXLEN
+# characters are cached, so each distinct
+# driver, userdef or run-parameter string is
+# only parsed once. File templates are compiled
+# and cached by TemplateCache, whose size limit
+# covers their compiled form.
+#============================================
+Placeholder = namedtuple('Placeholder', ['name', 'inlineFmt', 'raw'])
+
+def compileTemplate(inStr):
+	"""Split a string into literal strings and Placeholder entries, cached for short strings"""
+
+	if(len(inStr) > TEMPLATE_CACHE_MAXLEN):
+		return parseTemplate(inStr)
+	return compileShortTemplate(inStr)
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compileShortTemplate(inStr):
+	return parseTemplate(inStr)
 
-	# Get thread information
-	threadInfo = getThreadInfo()
+def parseTemplate(inStr):
+	"""Split a string into literal strings and Placeholder entries"""
 
-	# Move through the input string, replacing all found
-	# parameters in turn
+	segments = []
 	countBeg = 0
-	indBeg   = -1
-	indEnd   = -1
 	while(True):
-		# Attempt to find the first instance of the
-		# parameter identifier. If found, attempt to
-		# find the parameter end. If the beginning
-		# identifier is found, there are no more parameters
-		# in the string and we can abort.
-		indBeg = inStr.find(begStr, countBeg)
-		if(indBeg>=0):
-			indEnd = inStr.find(endStr, indBeg+1)
-		else:
+		indBeg = inStr.find(PARAM_BEG, countBeg)
+		if(indBeg<0):
 			break
-
-		if(indBeg>0 and indEnd<0):
+		indEnd = inStr.find(PARAM_END, indBeg+len(PARAM_BEG))
+		if(indEnd<0):
 			abort('Potentially malformed string "%s"'%inStr)
 
-		# Once a parameter has been identified, we will
-		# begin attempting to resolve it. Resolution occurs
-		# using defined values in the following order:
-		# 1) driver values
-		# 2) user values
-		# 3) input values [optional]
-		# Input values are passed as a dictionary to this function,
-		# and are meant to be used to resolve strings that depend
-		# on a particular choice of variable data (specific tuple of data).
-		#
-		# If an input value is used, we also check to see if the type of
-		# the resolved value is provided a format. If so, we use that to
-		# generate the resolved string. Otherwise, we use default formatting.
-		subStr = inStr[indBeg+len(begStr):indEnd]
+		if(indBeg>countBeg):
+			segments.append(inStr[countBeg:indBeg])
 
+		subStr = inStr[indBeg+len(PARAM_BEG):indEnd]
 		inlineFmt = None
 		indTmp = subStr.find(':')
 		if(indTmp>=0):
 			inlineFmt = subStr[indTmp+1:]
 			subStr    = subStr[:indTmp]
 
-		resolvedValue = None
-		usedInput = False
-		tmpFmt = None
-		if(threadInfo is not None):
-			if(subStr in threadInfo.keys()):
-				resolvedValue = threadInfo[subStr]
-		if(inputData is not None):
-			if(subStr in inputData.keys()):
-				resolvedValue = inputData[subStr]
-		if(subStr in userData.keys()):
-			resolvedValue = userData[subStr]
-		if(subStr in driverData.keys()):
-			resolvedValue = driverData[subStr]
-		if(resolvedValue is None):
-			abort('Unable to fully resolve "{}"'.format(begStr+subStr+endStr))
-
-		# Recurse if the resolution results in another parameter
-		resolvedValue = interpolateString(resolvedValue, inputData, inputFmt, nCalls+1)
-
-		# If the result is an evaluatable expression (encased by ` characters),
-		# perform the evaluation call. Evaluate string is, itself, recursive.
-		resolvedValue = evaluateStr(resolvedValue)
-
-
-		if(inlineFmt is not None):
-			resolvedValue = ('{:'+inlineFmt+'}').format(resolvedValue)
-		elif(inputFmt is not None and type(resolvedValue) in inputFmt.keys()):
-			resolvedValue = ('{:'+inputFmt[type(resolvedValue)]+'}').format(resolvedValue)
+		segments.append(Placeholder(subStr, inlineFmt, inStr[indBeg:indEnd+1]))
+		countBeg = indEnd+1
+
+	if(countBeg<len(inStr)):
+		segments.append(inStr[countBeg:])
+
+	return tuple(segments)
+
+#============================================
+# lookupParameter: Resolve a single parameter
+# name using defined values in the following
+# order of precedence:
+# 1) driver values
+# 2) user values
+# 3) input values [optional]
+# 4) thread values
+# Input values are passed as a dictionary, and
+# are meant to be used to resolve strings that
+# depend on a particular choice of variable
+# data (specific tuple of data).
+#============================================
+def lookupParameter(name, inputData=None):
+	"""Return the raw (unresolved) value of a parameter, or None if undefined"""
+
+	if(name in driverData):
+		return driverData[name]
+	if(name in userData):
+		return userData[name]
+	if(inputData is not None and name in inputData):
+		return inputData[name]
+	if(name == 'thread'):
+		return getThreadInfo()[name]
+	return None
+
+#============================================
+# interpolateString: Recursively replace
+# parameters in a given string based on
+# driver, user, and [optional] input data
+#============================================
+def interpolateString(inStr, inputData=None, inputFmt=None, nCalls=0, segments=None):
+	"""Given an input string (and optionally its compiled segments), replace all parameters and return the resolved string"""
+
+	if(inStr is None):
+		return None
+
+	if(not isinstance(inStr,str)):
+		return inStr
+
+	if(nCalls>=MAX_RECURS):
+		abort('Maximum number of recursions exceeded ({})'.format(MAX_RECURS))
+
+	if(segments is None):
+		segments = compileTemplate(inStr)
+	folds = getFoldedValues(inputData, inputFmt)
+
+	parts = []
+	for seg in segments:
+		if(isinstance(seg,str)):
+			parts.append(seg)
+			continue
+
+		if(folds is not None and seg.name in folds):
+			# Value was resolved ahead of time by foldParameters
+			resolvedValue = folds[seg.name]
 		else:
-			resolvedValue = '{}'.format(resolvedValue)
+			resolvedValue = lookupParameter(seg.name, inputData)
+			if(resolvedValue is None):
+				abort('Unable to fully resolve "{}"'.format(seg.raw))
 
+			# Recurse if the resolution results in another parameter
+			resolvedValue = interpolateString(resolvedValue, inputData, inputFmt, nCalls+1)
 
-		# Update the string with the resolved value and prepare to find next
-		# parameter
-		outStr = outStr.replace(inStr[indBeg:indEnd+1],resolvedValue)
+			# If the result is an evaluatable expression (encased by ` characters),
+			# perform the evaluation call. Evaluate string is, itself, recursive.
+			resolvedValue = evaluateStr(resolvedValue)
 
-		countBeg = indEnd+1
+		# If the type of the resolved value is provided a format, use that to
+		# generate the resolved string. Otherwise, use default formatting.
+		if(seg.inlineFmt is not None):
+			parts.append(format(resolvedValue, seg.inlineFmt))
+		elif(inputFmt is not None and type(resolvedValue) in inputFmt):
+			parts.append(format(resolvedValue, inputFmt[type(resolvedValue)]))
+		else:
+			parts.append(format(resolvedValue, ''))
 
 	# Final return!
-	return outStr
+	return ''.join(parts)
+
+#============================================
+# compileExpression: Parse and compile a single
+# expression to bytecode. Access to private or
+# dunder names and attributes is rejected, as
+# the expression only sees exprNamespace.
+# Results are cached (LRU) so each distinct
+# expression is only compiled once.
+#============================================
+@functools.lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compileExpression(exprStr):
+	"""Compile an expression string into a code object for eval"""
+
+	try:
+		tree = ast.parse(exprStr.strip(), mode='eval')
+	except SyntaxError as e:
+		abort('Unable to parse expression "{}": {}'.format(exprStr, e.msg))
+
+	for node in ast.walk(tree):
+		if(isinstance(node, ast.Attribute) and node.attr.startswith('_')):
+			abort('Access to attribute "{}" not allowed in expression "{}"'.format(node.attr, exprStr))
+		if(isinstance(node, ast.Name) and node.id.startswith('_')):
+			abort('Access to name "{}" not allowed in expression "{}"'.format(node.id, exprStr))
+
+	return compile(tree, '<expression>', 'eval')
 
 #============================================
 # evaluateStr: Recursively evaluate embedded
 # expressions in the provided string
 #============================================
 def evaluateStr(inStr):
+	"""Evaluate a string enclosed in backticks and return the result"""
+
 	if(not isinstance(inStr,str)):
 		return inStr
 
-	inds = [i for i, char in enumerate(inStr) if char == '`']
-	N = len(inds)
+	N = inStr.count(EXPR_DELIM)
 
 	if(N==0):
 		return inStr
@@ -401,17 +1137,309 @@ def evaluateStr(inStr):
 	if(N%2 != 0):
 		abort('Odd number of evaluator characters (`) found in {:s}'.format(inStr))
 
-	outStr = inStr
-	N=N/2
-	if(N==1):
-		outStr = eval(inStr[1:-1])
+	if(N==2):
+		return eval(compileExpression(inStr[1:-1]), exprNamespace)
+
+	indBeg = inStr.find(EXPR_DELIM)
+	indEnd = inStr.rfind(EXPR_DELIM)
+	return evaluateStr(inStr[indBeg+1:indEnd-1])
+
+#============================================
+# evaluateVectorized: Evaluate a single
+# parameterized expression (e.g. "`%(a)*%(b)`")
+# across many sets of input data at once.
+# Placeholders whose values are given in
+# inputList become NumPy arrays; all other
+# placeholders are resolved once. Falls back
+# to evaluating each entry in turn if NumPy is
+# unavailable or the expression cannot be
+# vectorized (e.g. non-numeric values, inline
+# formats). Integer arrays hold Python ints, so
+# they cannot overflow, and floating point
+# errors raise; any arithmetic error falls back
+# to the scalar path, which reports it as it
+# would without vectorization.
+#============================================
+def pow_vectorized(x, y):
+	"""Vectorized equivalent of math.pow, which always returns floats"""
+	return np.power(np.asarray(x, dtype=float), y)
+
+def evaluateVectorized(inStr, inputList):
+	"""Evaluate an expression for each dict in inputList and return a list of results"""
+
+	inputList = list(inputList)
+	scalarPath = lambda: [evaluateStr(interpolateString(inStr, d)) for d in inputList]
+
+	if(np is None or not inputList or not isinstance(inStr,str)):
+		return scalarPath()
+	if(inStr.count(EXPR_DELIM)!=2 or not (inStr.startswith(EXPR_DELIM) and inStr.endswith(EXPR_DELIM))):
+		return scalarPath()
+
+	namespace = {'__builtins__': {},
+	             'sqrt': np.sqrt, 'pow': pow_vectorized, 'abs': np.abs,
+	             'min': np.minimum, 'max': np.maximum}
+
+	# Rebuild the expression with placeholders replaced by array names
+	source = []
+	arrays = dict()
+	for seg in compileTemplate(inStr[1:-1]):
+		if(isinstance(seg,str)):
+			source.append(seg)
+			continue
+		if(seg.inlineFmt is not None):
+			return scalarPath()
+
+		# Parameters that are not per-entry must resolve to a plain number
+		if(seg.name in driverData or seg.name in userData or seg.name not in inputList[0]):
+			value = lookupParameter(seg.name)
+			if(type(value) not in (int, float)):
+				return scalarPath()
+			source.append('({!r})'.format(value))
+			continue
+
+		values = [d.get(seg.name) for d in inputList]
+		valueType = type(values[0])
+		if(valueType not in (int, float) or any(type(v) is not valueType for v in values)):
+			return scalarPath()
+		varName = 'v{:d}'.format(len(arrays))
+		if(seg.name not in arrays):
+			arrays[seg.name] = (varName, np.array(values, dtype=object if valueType is int else float))
+		source.append(arrays[seg.name][0])
+
+	namespace.update({v[0]: v[1] for v in arrays.values()})
+	try:
+		with np.errstate(all='raise'):
+			result = eval(compileExpression(''.join(source)), namespace)
+	except (NameError, TypeError, AttributeError, ArithmeticError, ValueError):
+		return scalarPath()
+
+	result = np.broadcast_to(result, (len(inputList),))
+	return result.tolist()
+
+#============================================
+# evaluateRuns: Evaluate a per-run expression
+# of the run sections (e.g. 'priority' or
+# 'cost') for a list of runs. With the driver
+# parameter 'vectorize', the expression of each
+# section is evaluated for all of its runs at
+# once (see evaluateVectorized).
+#============================================
+def evaluateRuns(key, runs, default=0):
+	"""Return the value of expression key of the run sections for each (section, idx) in runs"""
+
+	positions = OrderedDict()
+	for i, (section, idx) in enumerate(runs):
+		positions.setdefault(section, []).append(i)
+
+	values = [None]*len(runs)
+	for section, indices in positions.items():
+		expr = runData[section].get(key, default)
+		if(not isinstance(expr,str)):
+			results = [expr]*len(indices)
+		else:
+			inputs = [runSpaces[section].build(runs[i][1]) for i in indices]
+			if(driverData['vectorize']):
+				results = evaluateVectorized(expr, inputs)
+			else:
+				results = [evaluateStr(interpolateString(expr, d)) for d in inputs]
+		for i, value in zip(indices, results):
+			values[i] = float(value)
+	return values
+
+#============================================
+# foldParameters: Resolve parameters that do
+# not depend on individual runs ahead of the
+# sweep. The dependency graph of all driver,
+# user and run-section parameters is walked for
+# every run section, and each value is assigned
+# the widest scope it can be resolved at:
+#   global  - depends only on driver/user data
+#   section - constant within a run* section
+#   run     - depends on a run variable
+#   dynamic - depends on file parameters, the
+#             thread or undefined parameters
+# Global and section values are resolved once
+# and stored in foldedData. Cyclic parameter
+# definitions abort here rather than at
+# MAX_RECURS during the sweep.
+#============================================
+def getFoldedValues(inputData, inputFmt):
+	"""Return the folded values usable for the given input data and format, or None"""
+
+	if(not foldedData):
+		return None
+	if(inputFmt is None):
+		fmtKey = 'none'
+	elif(inputFmt is fmtLong):
+		fmtKey = 'long'
 	else:
-		subStr   = inStr[inds[0]+1:inds[-1]-1]
-		evaldStr = evaluateStr(subStr)
-		# outStr   = outStr.replace(subStr,evaldStr)
-		outStr   = evaldStr
+		return None
+	section = getattr(inputData, 'section', None)
+	return foldedData.get((section, fmtKey), foldedData.get((None, fmtKey)))
+
+def parameterDependencies(value):
+	"""Return the names of all parameters referenced by a value"""
+
+	if(not isinstance(value,str)):
+		return ()
+	return tuple(seg.name for seg in compileTemplate(value) if not isinstance(seg,str))
+
+def parameterScopes(section):
+	"""Determine the scope of every parameter visible in a run section (or globally if None)"""
+
+	fileKeys = set()
+	for fdata in fileData.values():
+		if(fdata['parameters']):
+			fileKeys.update(fdata['parameters'].keys())
+
+	rdata = runData[section] if section is not None else None
+	params = (rdata.get('parameters') or dict()) if rdata is not None else dict()
+
+	scopes = dict()
+
+	def scopeOf(name, stack):
+		if(name in scopes):
+			return scopes[name]
+		if(name in stack):
+			cycle = stack[stack.index(name):] + [name]
+			abort('Cyclic parameter definition: {}'.format(' -> '.join(cycle)))
+
+		if(name in driverData or name in userData):
+			value = lookupParameter(name)
+			scope = SCOPE_GLOBAL
+		elif(name in fileKeys):
+			return SCOPE_DYNAMIC
+		elif(name in params):
+			# Run parameters take precedence over run variables
+			value = params[name]
+			scope = SCOPE_SECTION
+		elif(rdata is not None and name in rdata['variables']):
+			scopes[name] = SCOPE_RUN
+			return SCOPE_RUN
+		else:
+			# Thread information or undefined; resolved (or aborted) at run time
+			return SCOPE_DYNAMIC
+
+		if(value is None):
+			return SCOPE_DYNAMIC
+
+		for dep in parameterDependencies(value):
+			scope = max(scope, scopeOf(dep, stack+[name]))
+		scopes[name] = scope
+		return scope
+
+	names = list(driverData.keys()) + list(userData.keys()) + list(params.keys())
+	for name in names:
+		scopeOf(name, [])
+
+	return scopes
+
+def foldParameters():
+	"""Resolve global and per-section parameters once, before any run is executed"""
+
+	global folding
+
+	foldedData.clear()
+
+	formats = (('none', None), ('long', fmtLong))
+	sections = [None] + list(runData.keys())
+	for section in sections:
+		scopes = parameterScopes(section)
+		target = SCOPE_GLOBAL if section is None else SCOPE_SECTION
+
+		inputData = None
+		if(section is not None):
+			inputData = RunInstance(section, runData[section].get('parameters') or dict())
+
+		folded = set()
+		for fmtKey, fmt in formats:
+			folds = dict(foldedData.get((None, fmtKey), dict()))
+			for name, scope in scopes.items():
+				if(scope != target):
+					continue
+				value = lookupParameter(name, inputData)
+				if(not isinstance(value,str) or (PARAM_BEG not in value and EXPR_DELIM not in value)):
+					continue
+				folding = True
+				try:
+					folds[name] = evaluateStr(interpolateString(value, inputData, fmt, 1))
+				except Exception:
+					# Leave values that fail to evaluate to be reported at run time
+					continue
+				finally:
+					folding = False
+				folded.add(name)
+			foldedData[(section, fmtKey)] = folds
+
+		logInfo('Folded {:d} parameters for {}'.format(len(folded),
+			'global scope' if section is None else 'section "{}"'.format(section)))
+
+#============================================
+# TemplateCache: Thread-safe, size-limited LRU
+# cache of template file contents, shared by
+# all runs. Entries are keyed by absolute path,
+# modification time and size, so a template
+# which changes on disk (or differs per run) is
+# reloaded. Templates are cached together with
+# their compiled segments (see compileTemplate),
+# and the size of both counts against the
+# limit of the cache.
+#============================================
+def templateBytes(content, segments):
+	"""Approximate memory held by a template and its compiled segments"""
+
+	nBytes = sys.getsizeof(content) + sys.getsizeof(segments)
+	for seg in segments:
+		nBytes += sys.getsizeof(seg)
+		if(not isinstance(seg,str)):
+			nBytes += sum(sys.getsizeof(v) for v in seg)
+	return nBytes
+
+class TemplateCache(object):
+	"""LRU cache of compiled template files keyed by (path, mtime, size)"""
+
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.nBytes   = 0
+		self.entries  = OrderedDict()
+		self.keys     = dict()
+		self.lock     = threading.Lock()
+
+	def load(self, path):
+		"""Return the contents of a template file and its compiled segments, reading it only if not cached"""
+
+		st = os.stat(path)
+		key = (path, st.st_mtime_ns, st.st_size)
+		with self.lock:
+			if(key in self.entries):
+				self.entries.move_to_end(key)
+				return self.entries[key][:2]
 
-	return outStr
+		with open(path,'r') as pfile:
+			content = pfile.read()
+		segments = parseTemplate(content)
+		nBytes = templateBytes(content, segments)
+
+		with self.lock:
+			# Drop a stale version of the same file
+			oldKey = self.keys.pop(path, None)
+			if(oldKey is not None and oldKey in self.entries):
+				self.nBytes -= self.entries.pop(oldKey)[2]
+
+			if(nBytes <= self.maxBytes):
+				self.entries[key] = (content, segments, nBytes)
+				self.keys[path] = key
+				self.nBytes += nBytes
+
+			# Evict least recently used templates
+			while(self.nBytes > self.maxBytes):
+				oldKey, oldEntry = self.entries.popitem(last=False)
+				self.keys.pop(oldKey[0], None)
+				self.nBytes -= oldEntry[2]
+
+		return content, segments
+
+templateCache = TemplateCache(64*1024*1024)
 
 #============================================
 # processFiles: Process all defined files.
@@ -425,6 +1453,19 @@ def processFiles(instanceData):
 		processSingleFile(fileKey,instanceData)
 
 
+#============================================
+# fileInstanceData: Merge the data of a run
+# instance with the parameters of a file
+#============================================
+def fileInstanceData(fileKey, instanceData):
+	"""Return the run data extended with the parameters of a file section"""
+
+	data = instanceData
+	if('parameters' in fileData[fileKey].keys() and fileData[fileKey]['parameters']):
+		data = RunInstance(getattr(instanceData, 'section', None), instanceData)
+		data.update(fileData[fileKey]['parameters'])
+	return data
+
 #============================================
 # processSingleFile: Process a single file
 # with global and instance parameters
@@ -434,34 +1475,74 @@ def processSingleFile(fileKey,instanceData):
 		abort('Attempting to process nonexistent file with key '+fileKey)
 
 	# Merge instance data (from specific run instance) and the file's parameters
-	data = instanceData
-	if('parameters' in fileData[fileKey].keys() and fileData[fileKey]['parameters']):
-		data = {**data,**fileData[fileKey]['parameters']}
-
+	data = fileInstanceData(fileKey, instanceData)
 
 	# Load parameter template
 	templatefile = resolveAbsPath(interpolateString(fileData[fileKey]['input'],data))
-	logInfo('Loading template file {}'.format(templatefile))
+	logDebug('Loading template file %s', templatefile)
 	if(templatefile is None):
 		abort('Parameter template file is None!')
 
-	with open(templatefile,'r') as pfile:
-		paramStr = pfile.read()
+	paramStr, segments = templateCache.load(templatefile)
 
 	# Replace all parameterizations with driver, user, and instance data
-	paramStr = interpolateString(paramStr, data, fmtLong)
+	paramStr = interpolateString(paramStr, data, fmtLong, segments=segments)
 
-	# Write parameter file
+	# Write parameter file, unless it already has the rendered content
 	outputFile = resolveAbsPath(interpolateString(fileData[fileKey]['output'],data))
-	logInfo('Writing param file {}'.format(outputFile))
-	with open(outputFile,'w+') as pfile:
-		pfile.write(paramStr)
+	if(writeIfChanged(outputFile, paramStr)):
+		logDebug('Writing param file %s', outputFile)
+	else:
+		logDebug('Param file %s unchanged', outputFile)
 
 	# If the file is of type "pbs", record its output name
 	if(fileData[fileKey]['type'] == 'pbs'):
-		logInfo('adding to pbs files: {:s}'.format(outputFile))
+		logDebug('adding to pbs files: %s', outputFile)
 		pbsFiles.append(outputFile)
 
+#============================================
+# writeIfChanged: Write a generated file only if
+# its content differs from the existing file, so
+# unchanged files keep their modification time.
+# Files are written atomically: the content is
+# written to a temporary file in the same
+# directory, which is then renamed over the
+# output, so readers never see a partial file.
+#============================================
+def writeIfChanged(outputFile, content):
+	"""Atomically write content to outputFile if it differs. Returns True if written"""
+
+	encoded = content.encode(locale.getpreferredencoding(False))
+
+	unchanged = False
+	if(os.path.isfile(outputFile) and os.path.getsize(outputFile) == len(encoded)):
+		with open(outputFile,'rb') as pfile:
+			unchanged = (pfile.read() == encoded)
+
+	if(unchanged):
+		with fileStatsLock:
+			fileStats['unchanged'] += 1
+		return False
+
+	outDir, outName = os.path.split(outputFile)
+	fd, tmpFile = tempfile.mkstemp(dir=outDir, prefix='.'+outName+'.', suffix='.tmp')
+	try:
+		with os.fdopen(fd,'wb') as pfile:
+			pfile.write(encoded)
+		if(os.path.exists(outputFile)):
+			shutil.copymode(outputFile, tmpFile)
+		else:
+			os.chmod(tmpFile, 0o666 & ~UMASK)
+		os.replace(tmpFile, outputFile)
+	except BaseException:
+		if(os.path.exists(tmpFile)):
+			os.unlink(tmpFile)
+		raise
+
+	with fileStatsLock:
+		fileStats['written'] += 1
+	return True
+
 def constructPbsSubmitScript():
 	if(not pbsFiles):
 		return
@@ -469,81 +1550,2844 @@ def constructPbsSubmitScript():
 	header = "#!/bin/bash"
 	subscript = interpolateString(driverData['pbs_submitscript'])
 	logInfo('Creating PBS submission script: {:s}'.format(subscript))
+	if(driverData['pbs_mode'] == 'jobs' and driverData['pbs_pack'] == 1):
+		jobs = [os.path.split(f) for f in pbsFiles]
+	else:
+		jobs = constructPbsJobs()
 	with open(subscript,'w+') as output:
 		output.write(header)
 		output.write('\n')
-		for f in pbsFiles:
-			path, file = os.path.split(f)
+		for path, file in jobs:
 			output.write('cd {:s} && {:s} {:s} && cd -\n'.format(path,driverData['pbs_subcommand'],file))
 
-
 #============================================
-# worker: Function called for each thread.
-# Pulls a set of data off the run queue
-# (from the cartesian product) and executes
-# relevant activities
+# constructPbsJobs: Submit the PBS scripts of
+# many runs as few scheduler jobs. Runs whose
+# scripts request the same resources (the same
+# #PBS directives, other than the job name) are
+# grouped, and the runs of each group listed in
+# a manifest. Each job executes a share of the
+# manifest with 'chauffeur.py --manifest', which
+# runs the scripts of its runs concurrently:
+#   jobs  - one job per pbs_pack runs
+#   array - one job array per group, with a
+#           task per pbs_pack runs
+# Returns the (directory, file) of each job
+# script to submit.
 #============================================
-def worker():
-	"""Execute the driver specifications for a given set of parameters (threaded)"""
+def pbsDirectives(scriptFile):
+	"""Return the #PBS directives of a job script, other than its name"""
 
-	while True:
-		data = runqueue.get()
-		if data is None:
-			return
+	with open(scriptFile,'r') as f:
+		directives = [line.rstrip() for line in f if line.startswith('#PBS')]
+	name = next((d for d in directives if d.split()[1:2] == ['-N']), None)
+	return tuple(d for d in directives if d != name), name
 
-		# Copy template to working directory
+def constructPbsJobs():
+	"""Write the manifests and job scripts of grouped PBS runs"""
+
+	jobDir = resolveAbsPath(interpolateString(driverData['pbs_jobdir']))
+	os.makedirs(jobDir, exist_ok=True)
+	pack = int(driverData['pbs_pack'])
+	if(pack < 1):
+		abort('pbs_pack must be at least 1')
+
+	groups = OrderedDict()
+	for f in sorted(set(pbsFiles)):
+		directives, name = pbsDirectives(f)
+		groups.setdefault(directives, []).append((f, name))
+
+	jobs = []
+	for g, (directives, entries) in enumerate(groups.items()):
+		manifest = os.path.join(jobDir, 'manifest_{:d}.jsonl'.format(g))
+		writeIfChanged(manifest, ''.join(json.dumps({'workdir': os.path.dirname(f), 'script': f})+'\n'
+		                                 for f, _name in entries))
+		nJobs = -(-len(entries)//pack)
+		name = entries[0][1]
+		command = '{} {} --manifest {} --shard {{}}/{:d}'.format(shlex.quote(sys.executable),
+			shlex.quote(driverData['scriptdir']), shlex.quote(manifest), nJobs)
+
+		# A single job is submitted as a plain job, as an array of one task
+		# (-J 0-0) is rejected by PBS
+		if(driverData['pbs_mode'] == 'array' and nJobs > 1):
+			scripts = [('array_{:d}.sh'.format(g), ['{} 0-{:d}'.format(driverData['pbs_arrayflag'], nJobs-1)], 'auto')]
+		else:
+			scripts = [('pack_{:d}_{:d}.sh'.format(g, k), [], str(k)) for k in range(nJobs)]
+
+		for file, extra, shard in scripts:
+			lines = ['#!/bin/bash'] + ([name] if name else []) + list(directives)
+			lines += ['#PBS '+e for e in extra]
+			lines += ['', command.format(shard), '']
+			writeIfChanged(os.path.join(jobDir, file), '\n'.join(lines))
+			jobs.append((jobDir, file))
+		logInfo('PBS group {:d}: {:d} runs in {:d} job(s) ({})'.format(g, len(entries), nJobs, driverData['pbs_mode']))
+
+	return jobs
+
+#============================================
+# runManifest: Execute the job scripts of share
+# K/N of the runs listed in a manifest, all at
+# once, each in its run directory. Used inside
+# jobs generated by constructPbsJobs. Returns
+# the number of runs which failed.
+#============================================
+def runManifest(path, shardStr=None):
+	"""Execute a share of the run scripts listed in a manifest concurrently"""
+
+	with open(path,'r') as f:
+		entries = [json.loads(line) for line in f if line.strip()]
+	k, n = parseShard(shardStr) if shardStr is not None else (0, 1)
+	entries = entries[k::n]
+	logInfo('Executing {:d} runs of manifest {}'.format(len(entries), path))
+
+	def runEntry(entry, results):
+		interpreter = '/bin/sh'
+		with open(entry['script'],'r') as f:
+			first = f.readline()
+		if(first.startswith('#!')):
+			interpreter = first[2:].strip()
+		env = dict(os.environ, PBS_O_WORKDIR=entry['workdir'])
+		cmdStr = '{} {}'.format(interpreter, shlex.quote(entry['script']))
+		results[entry['script']], _usage = runCommand(cmdStr, entry['workdir'], env=env)
+
+	results = dict()
+	threads = [threading.Thread(target=runEntry, args=(entry, results), name='{:02d}'.format(i)) for i, entry in enumerate(entries)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	failed = 0
+	for entry in entries:
+		returncode = results.get(entry['script'])
+		logInfo('Run {} {} (exit code {})'.format(entry['workdir'], 'succeeded' if returncode == 0 else 'failed', returncode))
+		failed += returncode != 0
+	return failed
+
+
+#============================================
+# materializeTemplate: Create a work directory
+# from the template directory. Depending on
+# templatemode, files are copied, hardlinked,
+# cloned (reflink, copy-on-write) or symlinked
+# to the template. Symlinks in the template are
+# always reproduced as symlinks. Files listed in
+# realCopies (paths relative to the template
+# directory) are always copied, as they will be
+# rewritten in the work directory. If a link or
+# clone cannot be created (e.g. across
+# filesystems), the file is copied instead.
+#============================================
+linkFallbacks = set()
+
+def cloneFile(src, dst):
+	"""Create a copy-on-write clone of src at dst using the FICLONE ioctl"""
+
+	if(fcntl is None):
+		raise OSError('reflink copies are not supported on this platform')
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		try:
+			fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+		except OSError:
+			fdst.close()
+			os.unlink(dst)
+			raise
+	shutil.copystat(src, dst)
+
+def linkFile(src, dst, mode):
+	"""Materialize a single template file according to the template mode"""
+
+	try:
+		if(mode == 'hardlink'):
+			os.link(src, dst)
+			return
+		elif(mode == 'reflink'):
+			cloneFile(src, dst)
+			return
+		elif(mode == 'symlink-readonly'):
+			os.symlink(src, dst)
+			return
+	except OSError as e:
+		if(mode not in linkFallbacks):
+			linkFallbacks.add(mode)
+			logInfo('Unable to {} {} ({}). Falling back to copying files.'.format(mode, src, e))
+	shutil.copy2(src, dst)
+
+def materializeTemplate(templateDir, workDir, mode, realCopies=()):
+	"""Populate workDir from templateDir according to the template mode"""
+
+	if(mode == 'copy'):
+		shutil.copytree(templateDir,workDir,symlinks=True)
+		return
+
+	patterns = driverData['templatecopy'] or []
+	for root, dirs, files in os.walk(templateDir):
+		relRoot = os.path.relpath(root, templateDir)
+		dstRoot = os.path.normpath(os.path.join(workDir, relRoot))
+		os.makedirs(dstRoot)
+		shutil.copystat(root, dstRoot)
+
+		# Symlinked directories are reproduced as links and not descended into
+		for d in list(dirs):
+			if(os.path.islink(os.path.join(root, d))):
+				os.symlink(os.readlink(os.path.join(root, d)), os.path.join(dstRoot, d))
+				dirs.remove(d)
+
+		for f in files:
+			src = os.path.join(root, f)
+			dst = os.path.join(dstRoot, f)
+			relPath = os.path.normpath(os.path.join(relRoot, f))
+			if(os.path.islink(src)):
+				os.symlink(os.readlink(src), dst)
+			elif(relPath in realCopies or any(fnmatch.fnmatch(relPath, pat) for pat in patterns)):
+				shutil.copy2(src, dst)
+			else:
+				linkFile(src, dst, mode)
+
+#============================================
+# templateRealCopies: Paths (relative to the
+# work directory) of the files processed by
+# file* sections for a run. These are rewritten
+# in the work directory, so must never be
+# shared with the template.
+#============================================
+def templateRealCopies(data, workDir):
+	"""Return the set of relative paths of file* outputs inside workDir"""
+
+	realCopies = set()
+	for fileKey in fileData:
+		outputFile = resolveAbsPath(interpolateString(fileData[fileKey]['output'], fileInstanceData(fileKey, data)))
+		if(outputFile is not None and outputFile.startswith(workDir+os.sep)):
+			realCopies.add(os.path.relpath(outputFile, workDir))
+	return realCopies
+
+#============================================
+# setupRun: Prepare the work directory of a
+# single run: copy the template directory and
+# process all files. Returns the work directory,
+# or None if the run is skipped or no commands
+# should be executed for it.
+#============================================
+def setupRun(data, phases=None):
+	"""Copy the template and process files for a run, returning its work directory"""
+
+	if(phases is None):
+		phases = dict()
+
+	# Copy template to working directory
+	workDir = resolveAbsPath(interpolateString(driverData['rundir'],data))
+
+	# If the workDir exists, skip this run
+	if(driverData['skipifexist'] and driverData['templatedir'] and os.path.exists(workDir)):
+		logDebug('Work directory %s exists. Skipping this run.', workDir)
+		return None
+
+	templateDir = resolveAbsPath(interpolateString(driverData['templatedir'],data))
+	if(templateDir is not None):
+		logDebug('Copying %s to %s', templateDir, workDir)
+		if(wetRun):
+			tStart = time.time()
+			mode = driverData['templatemode']
+			realCopies = templateRealCopies(data, workDir) if mode != 'copy' else ()
+			materializeTemplate(templateDir, workDir, mode, realCopies)
+			phases['copy'] = {'wall': time.time()-tStart}
+
+	if(not wetRun):
+		return None
+
+	# Ensure that run directory exists. If not, create it.
+	if(not os.path.exists(workDir)):
+		logDebug('Creating run directory %s', workDir)
+		path = Path(workDir)
+		path.mkdir(parents=True)
+
+	# Process files
+	tStart = time.time()
+	processFiles(data)
+	if(fileData):
+		phases['files'] = {'wall': time.time()-tStart}
+
+	if(driverData['type'] in ['param_only','setup']):
+		return None
+
+	return workDir
+
+#============================================
+# getRunCommands: Resolve the pre, exec and
+# post commands of a run, in execution order
+#============================================
+def getRunCommands(data):
+	"""Return a list of (phase, command) pairs for a run"""
+
+	commands = []
+	if(driverData['precommand'] is not None):
+		commands.append(('pre', interpolateString(interpolateString(driverData['precommand'],data))))
+	if(driverData['execcommand'] is not None):
+		commands.append(('exec', interpolateString(interpolateString(driverData['execcommand'],data))))
+	if(driverData['postcommand'] is not None):
+		commands.append(('post', interpolateString(driverData['postcommand'],data)))
+	return commands
+
+#============================================
+# commandArgs: Decide how a command is started.
+# Simple commands are split and executed
+# directly, avoiding an extra /bin/sh; anything
+# using shell syntax or a shell builtin is run
+# through the shell, as is an executable which
+# cannot be executed directly (e.g. a script
+# without a shebang line, see shellFallback).
+#============================================
+def commandArgs(cmdStr):
+	"""Return (args, shell) for starting a command"""
+
+	if(SHELL_CHARS.intersection(cmdStr)):
+		return cmdStr, True
+	args = shlex.split(cmdStr)
+	if(not args or args[0] in SHELL_BUILTINS):
+		return cmdStr, True
+	return args, False
+
+def shellFallback(error, shell):
+	"""Whether a command which failed to start directly should be run through the shell instead"""
+
+	# Executables without a shebang line are run by the shell, as with sh -c
+	return not shell and error.errno == errno.ENOEXEC
+
+#============================================
+# startFailure: Report a command which could
+# not be started (e.g. a missing executable)
+# the way the shell would: with a message on
+# its standard error and exit code 127 (126 if
+# it is not executable), rather than raising.
+#============================================
+def startFailure(cmdStr, error, stderr, tStart):
+	"""Return (returncode, usage) of a command which failed to start"""
+
+	returncode = 126 if isinstance(error, PermissionError) else 127
+	msg = 'chauffeur: {}: {}\n'.format(cmdStr, error.strerror or error)
+	if(stderr is not None):
+		stderr.write(msg.encode('utf-8'))
+		stderr.flush()
+	else:
+		sys.stderr.write(msg)
+	return returncode, {'wall': time.time()-tStart, 'returncode': returncode}
+
+#============================================
+# RunLedger: Persistent SQLite record of runs,
+# keyed by a hash of each run's resolved
+# parameters. Stores the status (running,
+# interrupted, succeeded, failed, skipped), exit
+# codes and timings of every run, and whether
+# its work directory was created by chauffeur,
+# so that an interrupted sweep can be resumed:
+# succeeded runs are skipped, runs left in the
+# running state are marked interrupted and
+# executed again. Only the work directories of
+# interrupted runs which chauffeur created are
+# removed before they are executed again.
+#============================================
+class RunLedger(object):
+	"""Thread-safe SQLite ledger of run status"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+		                  'key TEXT PRIMARY KEY, section TEXT, idx TEXT, workdir TEXT, '
+		                  'status TEXT, returncodes TEXT, started REAL, finished REAL)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS runs_status ON runs (status)')
+		if('created' not in [row[1] for row in self.conn.execute('PRAGMA table_info(runs)')]):
+			self.conn.execute('ALTER TABLE runs ADD COLUMN created INTEGER')
+
+		# Runs left running by a previous (interrupted) invocation are requeued
+		nInterrupted = self.conn.execute('UPDATE runs SET status=? WHERE status=?',
+		                                 ('interrupted', 'running')).rowcount
+		self.conn.commit()
+		if(nInterrupted):
+			logInfo('Requeueing {:d} interrupted runs from ledger {}'.format(nInterrupted, path))
+
+		self.done = {row[0] for row in self.conn.execute('SELECT key FROM runs WHERE status=?', ('succeeded',))}
+		logInfo('Ledger {} holds {:d} succeeded runs'.format(path, len(self.done)))
+
+	def status(self, key):
+		"""Return the recorded status of a run, or None if it is not in the ledger"""
+		with self.lock:
+			row = self.conn.execute('SELECT status FROM runs WHERE key=?', (key,)).fetchone()
+		return row[0] if row else None
+
+	def interruptedCreated(self, key):
+		"""Return whether a run was interrupted in a work directory created by chauffeur"""
+		with self.lock:
+			row = self.conn.execute('SELECT status, created FROM runs WHERE key=?', (key,)).fetchone()
+		return row is not None and row[0] == 'interrupted' and bool(row[1])
+
+	def start(self, key, section, idx, workDir):
+		"""Record that a run has started, and whether its work directory is about to be created"""
+		created = workDir is not None and not os.path.exists(workDir)
+		with self.lock:
+			self.conn.execute('INSERT OR REPLACE INTO runs (key, section, idx, workdir, status, returncodes, started, finished, created) '
+			                  'VALUES (?,?,?,?,?,?,?,?,?)',
+			                  (key, section, json.dumps(list(idx)), workDir, 'running', None, time.time(), None, int(created)))
+			self.conn.commit()
+
+	def finish(self, key, status, returncodes):
+		"""Record the final status and exit codes of a run"""
+		with self.lock:
+			self.conn.execute('UPDATE runs SET status=?, returncodes=?, finished=? WHERE key=?',
+			                  (status, json.dumps(returncodes), time.time(), key))
+			self.conn.commit()
+		if(status == 'succeeded'):
+			self.done.add(key)
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+#============================================
+# RunTracer: Structured per-run trace. Each
+# finished run is written as one JSON line:
+#   {"version": 1, "section": ..., "idx": [...],
+#    "variables": {...}, "workdir": ...,
+#    "status": ..., "start": <epoch seconds>,
+#    "phases": {"copy": {"wall": ...},
+#               "files": {"wall": ...},
+#               "exec": {"wall": ..., "utime": ...,
+#                        "stime": ..., "maxrss_kb": ...,
+#                        "returncode": ...},
+#               "total": {"wall": ...}}}
+# Phases which do not apply to a run are
+# omitted. If profiling is enabled, wall-clock
+# times are also kept to summarize at exit.
+#============================================
+class RunTracer(object):
+	"""Writes per-run JSONL traces and collects profile statistics"""
+
+	NSLOWEST = 10
+
+	def __init__(self, path=None, profile=False):
+		self.out     = open(path,'w') if path is not None else None
+		self.profile = profile
+		self.walls   = OrderedDict()
+		self.slowest = []
+
+	def record(self, result):
+		"""Record the trace of a finished run"""
+
+		phases = dict((k, v) for k, v in result.phases.items() if k != 'start')
+		if(self.out is not None):
+			space = runSpaces[result.section]
+			entry = OrderedDict()
+			entry['version']   = TRACE_VERSION
+			entry['section']   = result.section
+			entry['idx']       = list(result.idx)
+			entry['variables'] = OrderedDict(sorted((v, vals[i]) for v, vals, i in zip(space.order, space.values, result.idx)))
+			entry['workdir']   = result.workDir
+			entry['status']    = result.status
+			entry['start']     = result.phases.get('start')
+			entry['phases']    = phases
+			self.out.write(json.dumps(entry, default=str)+'\n')
+			self.out.flush()
+
+		if(self.profile):
+			for phase, usage in phases.items():
+				self.walls.setdefault(phase, []).append(usage['wall'])
+			if('total' in phases):
+				item = (phases['total']['wall'], result.section, list(result.idx), result.workDir)
+				if(len(self.slowest) < self.NSLOWEST):
+					heapq.heappush(self.slowest, item)
+				else:
+					heapq.heappushpop(self.slowest, item)
+
+	def summary(self):
+		"""Log p50/p95/max wall-clock times per phase and the slowest runs"""
+
+		def percentile(values, q):
+			return values[min(len(values)-1, int(q*len(values)))]
+
+		logInfo('Profile (wall-clock seconds per phase):')
+		logInfo('  {:<8s} {:>8s} {:>10s} {:>10s} {:>10s}'.format('phase', 'count', 'p50', 'p95', 'max'))
+		for phase, walls in self.walls.items():
+			walls = sorted(walls)
+			logInfo('  {:<8s} {:>8d} {:>10.4f} {:>10.4f} {:>10.4f}'.format(phase, len(walls),
+			        percentile(walls, 0.50), percentile(walls, 0.95), walls[-1]))
+		logInfo('Slowest runs:')
+		for wall, section, idx, workDir in sorted(self.slowest, reverse=True):
+			logInfo('  {:10.4f}s {}{} ({})'.format(wall, section, idx, workDir))
+
+	def close(self):
+		if(self.profile):
+			self.summary()
+		if(self.out is not None):
+			self.out.close()
+
+#============================================
+# RuntimeHistory: Observed runtimes of succeeded
+# runs, appended to a JSONL file keyed by run
+# section and variable values, and a cost model
+# fitted to them. The model is multiplicative:
+# the log of the runtime of a run is the mean
+# log runtime of its section plus, for each of
+# its variables, the mean deviation from it of
+# runs sharing the variable's value. Values
+# never observed contribute nothing, and runs
+# of sections without history are expected to
+# take the mean runtime over all sections.
+#============================================
+class RuntimeHistory(object):
+	"""Records runtimes of finished runs and predicts those of new runs"""
+
+	def __init__(self, path):
+		self.entries = dict()
+		if(os.path.exists(path)):
+			with open(path,'r') as f:
+				for line in f:
+					if(line.strip()):
+						entry = json.loads(line)
+						self.entries.setdefault(entry['section'], []).append((entry['variables'], entry['runtime']))
+		self.out = open(path,'a')
+		self.fit()
+
+	@staticmethod
+	def valueKey(value):
+		return json.dumps(value, sort_keys=True, default=str)
+
+	def fit(self):
+		"""Fit the per-section, per-variable cost model to the recorded runtimes"""
+
+		self.model = dict()
+		allLogs = []
+		for section, entries in self.entries.items():
+			logs = [log(max(runtime, 1e-6)) for _variables, runtime in entries]
+			mean = sum(logs)/len(logs)
+			effects = dict()
+			for (variables, _runtime), logRuntime in zip(entries, logs):
+				for var, value in variables.items():
+					effects.setdefault(var, dict()).setdefault(self.valueKey(value), []).append(logRuntime-mean)
+			self.model[section] = (mean, dict((var, dict((k, sum(d)/len(d)) for k, d in values.items()))
+			                                  for var, values in effects.items()))
+			allLogs.extend(logs)
+		self.mean = sum(allLogs)/len(allLogs) if allLogs else None
+
+	def predict(self, section, idx):
+		"""Expected runtime of a run in seconds, or None without any history"""
+
+		if(section not in self.model):
+			return exp(self.mean) if self.mean is not None else None
+		mean, effects = self.model[section]
+		space = runSpaces[section]
+		logRuntime = mean
+		for var, values, i in zip(space.order, space.values, idx):
+			logRuntime += effects.get(var, {}).get(self.valueKey(values[i]), 0.0)
+		return exp(logRuntime)
+
+	def record(self, result):
+		"""Record the runtime of a run which executed its commands successfully"""
+
+		if(result.status != 'succeeded' or 'total' not in result.phases):
+			return
+		space = runSpaces[result.section]
+		variables = OrderedDict(sorted((v, vals[i]) for v, vals, i in zip(space.order, space.values, result.idx)))
+		entry = OrderedDict([('section', result.section), ('variables', variables),
+		                     ('runtime', result.phases['total']['wall'])])
+		self.out.write(json.dumps(entry, default=str)+'\n')
+		self.out.flush()
+
+	def close(self):
+		self.out.close()
+
+#============================================
+# ResultCache: Content-addressed store of the
+# declared outputs of succeeded runs. A run is
+# keyed by a hash of its resolved commands, the
+# content of its generated files and a digest of
+# the template directory, so identical runs of
+# overlapping sweeps are only executed once. On
+# a hit, the outputs are restored into the work
+# directory (as hard links where possible)
+# instead of executing the run's commands.
+#
+# Entries are stored in <path>/entries/<key>,
+# as read-only copies, and indexed in an SQLite
+# database. Once the total size of the entries
+# exceeds the cap, the least recently used ones
+# are evicted.
+#============================================
+class ResultCache(object):
+	"""Thread-safe store of run outputs keyed by run content"""
+
+	def __init__(self, path, maxBytes):
+		self.path     = path
+		self.maxBytes = maxBytes
+		self.lock = threading.Lock()
+		os.makedirs(os.path.join(path, 'entries'), exist_ok=True)
+		self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+		                  'key TEXT PRIMARY KEY, files TEXT, size INTEGER, created REAL, used REAL)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+		self.conn.commit()
+
+	def entryDir(self, key):
+		return os.path.join(self.path, 'entries', key)
+
+	def restore(self, key, workDir):
+		"""Restore the outputs of a cached run into workDir. Returns False on a miss."""
+
+		with self.lock:
+			row = self.conn.execute('SELECT files FROM entries WHERE key=?', (key,)).fetchone()
+			if(row is None):
+				return False
+			self.conn.execute('UPDATE entries SET used=? WHERE key=?', (time.time(), key))
+			self.conn.commit()
+
+			for relPath in json.loads(row[0]):
+				src = os.path.join(self.entryDir(key), relPath)
+				dst = os.path.join(workDir, relPath)
+				os.makedirs(os.path.dirname(dst), exist_ok=True)
+				if(os.path.lexists(dst)):
+					os.unlink(dst)
+				try:
+					os.link(src, dst)
+				except OSError:
+					shutil.copy2(src, dst)
+		return True
+
+	def store(self, key, workDir, patterns):
+		"""Store the outputs of a succeeded run, matching patterns relative to workDir"""
+
+		files = set()
+		for pattern in patterns:
+			for path in Path(workDir).glob(pattern):
+				if(path.is_file()):
+					files.add(str(path.relative_to(workDir)))
+		files = sorted(files)
+
+		entryDir = self.entryDir(key)
+		tmpDir = tempfile.mkdtemp(dir=os.path.join(self.path, 'entries'), prefix='.'+key[:8])
+		size = 0
+		for relPath in files:
+			dst = os.path.join(tmpDir, relPath)
+			os.makedirs(os.path.dirname(dst), exist_ok=True)
+			shutil.copy2(os.path.join(workDir, relPath), dst)
+			os.chmod(dst, os.stat(dst).st_mode & ~0o222)
+			size += os.path.getsize(dst)
+
+		with self.lock:
+			if(os.path.exists(entryDir)):
+				shutil.rmtree(tmpDir)
+				return
+			os.rename(tmpDir, entryDir)
+			now = time.time()
+			self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+			                  (key, json.dumps(files), size, now, now))
+			self.conn.commit()
+		self.prune(self.maxBytes)
+
+	def prune(self, maxBytes):
+		"""Evict least recently used entries until the cache holds at most maxBytes"""
+
+		evicted = 0
+		with self.lock:
+			total = self.conn.execute('SELECT COALESCE(SUM(size),0) FROM entries').fetchone()[0]
+			if(total <= maxBytes):
+				return 0
+			for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY used').fetchall():
+				if(total <= maxBytes):
+					break
+				self.conn.execute('DELETE FROM entries WHERE key=?', (key,))
+				shutil.rmtree(self.entryDir(key), ignore_errors=True)
+				total -= size
+				evicted += 1
+			self.conn.commit()
+		return evicted
+
+	def info(self):
+		"""Return (entries, total bytes, oldest use, newest use)"""
+
+		with self.lock:
+			return self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size),0), MIN(used), MAX(used) FROM entries').fetchone()
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+@functools.lru_cache(maxsize=None)
+def templateDigest(templateDir):
+	"""Digest of the file names and contents of a template directory (computed once)"""
+
+	digest = hashlib.sha256()
+	for root, dirs, files in os.walk(templateDir):
+		dirs.sort()
+		for name in sorted(files):
+			path = os.path.join(root, name)
+			digest.update(os.path.relpath(path, templateDir).encode('utf-8')+b'\0')
+			if(not os.path.islink(path)):
+				with open(path,'rb') as f:
+					for block in iter(lambda: f.read(1 << 20), b''):
+						digest.update(block)
+			digest.update(b'\0')
+	return digest.hexdigest()
+
+def cacheKey(data, workDir):
+	"""Return the result cache key of a run whose files have been generated"""
+
+	content = dict()
+	content['commands'] = getRunCommands(data)
+	content['outputs']  = resultCacheOutputs(data)
+	templateDir = resolveAbsPath(interpolateString(driverData['templatedir'],data))
+	content['template'] = templateDigest(templateDir) if templateDir is not None else None
+
+	files = dict()
+	for fileKey in fileData:
+		outputFile = resolveAbsPath(interpolateString(fileData[fileKey]['output'], fileInstanceData(fileKey, data)))
+		with open(outputFile,'rb') as f:
+			files[os.path.relpath(outputFile, workDir)] = hashlib.sha256(f.read()).hexdigest()
+	content['files'] = files
+
+	encoded = json.dumps(content, sort_keys=True, default=str)
+	return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def resultCacheOutputs(data):
+	"""Return the resolved output patterns of a run"""
+
+	outputs = driverData['outputs'] or []
+	if(isinstance(outputs,str)):
+		outputs = [outputs]
+	return [interpolateString(pattern, data) for pattern in outputs]
+
+#============================================
+# Result collection: the postcollect section
+# names files in the work directory of each run
+# and the parser used to read values from them:
+#   regex    - named groups of the last match
+#              of 'pattern'
+#   keyvalue - lines of the form key=value
+#              (separator 'sep')
+#   csv      - row 'row' (by default the last)
+#              of a CSV file with a header
+#   json     - the value at a dotted 'path', or
+#              a mapping of column names to
+#              paths
+# As runs finish, their files are parsed by a
+# pool of nworkers threads, and a row per run
+# with its section, status, work directory,
+# variables and parsed values is streamed to
+# the output (.csv or .jsonl). The columns of
+# a .csv output are known up front for regex
+# and json parsers; with keyvalue or csv
+# parsers (and no 'columns'), the keys depend
+# on the files, and rows are held until the
+# sweep is complete so that the header can
+# list all of them. A .npz output holds an
+# array per column, and is written once the
+# sweep is complete.
+#============================================
+def collectValue(text):
+	"""Convert a parsed string to an int or float, where possible"""
+
+	text = text.strip()
+	for conv in (int, float):
+		try:
+			return conv(text)
+		except ValueError:
+			pass
+	return text
+
+def parseRegex(text, spec):
+	match = None
+	for match in spec['pattern'].finditer(text):
+		pass
+	if(match is None):
+		return dict()
+	return dict((k, collectValue(v)) for k, v in match.groupdict().items() if v is not None)
+
+def parseKeyValue(text, spec):
+	values = dict()
+	for line in text.splitlines():
+		key, sep, value = line.partition(spec['sep'])
+		if(sep and key.strip() and not key.lstrip().startswith('#')):
+			values[key.strip()] = collectValue(value)
+	return values
+
+def parseCsv(text, spec):
+	rows = list(csv.DictReader(text.splitlines()))
+	try:
+		row = rows[int(spec['row'])]
+	except IndexError:
+		return dict()
+	return dict((k.strip(), collectValue(v)) for k, v in row.items() if k is not None and v is not None)
+
+def parseJson(text, spec):
+	doc = json.loads(text)
+	values = dict()
+	for name, path in spec['path'].items():
+		value = doc
+		try:
+			for part in str(path).split('.'):
+				value = value[int(part)] if isinstance(value, list) else value[part]
+		except (KeyError, IndexError, ValueError, TypeError):
+			continue
+		values[name] = value
+	return values
+
+COLLECT_PARSERS = {'regex': parseRegex, 'keyvalue': parseKeyValue, 'csv': parseCsv, 'json': parseJson}
+
+def parsedColumns():
+	"""Return the names of the values parsed from result files, or None if they depend on the files"""
+
+	columns = []
+	for spec in collectData['files']:
+		if(spec['parser'] == 'regex'):
+			names = sorted(spec['pattern'].groupindex, key=spec['pattern'].groupindex.get)
+		elif(spec['parser'] == 'json'):
+			names = list(spec['path'])
+		else:
+			return None
+		columns += [name for name in names if name not in columns]
+	return columns
+
+class ResultCollector(object):
+	"""Parses the outputs of finished runs in a thread pool and writes a row per run"""
+
+	def __init__(self, path, nWorkers, columns=None):
+		self.path      = path
+		self.format    = os.path.splitext(path)[1]
+		self.columns   = list(columns) if columns is not None else None
+		self.variables = sorted(set(v for space in runSpaces.values() for v in space.order))
+		self.parsed    = parsedColumns()
+		self.lock      = threading.Lock()
+		self.nRows     = 0
+		self.rows      = []
+		self.dropped   = set()
+		self.writer    = None
+		self.out = open(path, 'w', newline='') if self.format != '.npz' else None
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=int(nWorkers), thread_name_prefix='collect')
+
+	def submit(self, result):
+		"""Queue the outputs of a finished run for collection"""
+
+		if(result.status in COLLECT_STATUSES):
+			self.pool.submit(self.collect, result)
+
+	def collect(self, result):
+		"""Parse the outputs of a run and write its row"""
+
+		space = runSpaces[result.section]
+		data = space.build(result.idx)
+		workDir = result.workDir or resolveAbsPath(interpolateString(driverData['rundir'], data))
+		if(not os.path.isdir(workDir)):
+			return
+
+		row = OrderedDict([('section', result.section), ('status', result.status), ('workdir', workDir)])
+		row.update(sorted((v, vals[i]) for v, vals, i in zip(space.order, space.values, result.idx)))
+		for spec in collectData['files']:
+			path = os.path.join(workDir, interpolateString(spec['file'], data))
+			if(not os.path.exists(path)):
+				logDebug('Result file %s does not exist', path)
+				continue
+			try:
+				with open(path, 'r') as f:
+					row.update(COLLECT_PARSERS[spec['parser']](f.read(), spec))
+			except (OSError, ValueError, csv.Error) as e:
+				logInfo('Unable to parse result file %s: %s', path, e)
+		self.write(row)
+
+	def write(self, row):
+		with self.lock:
+			self.nRows += 1
+			if(self.format == '.jsonl'):
+				self.out.write(json.dumps(row, default=str)+'\n')
+				self.out.flush()
+				return
+			if(self.format == '.npz' or (self.columns is None and self.parsed is None)):
+				self.rows.append(row)
+				return
+			self.writeRow(row)
+
+	def header(self):
+		"""Columns of the table: the given columns, or all variables and parsed values"""
+
+		if(self.columns is not None):
+			return self.columns
+		columns = ['section', 'status', 'workdir']+self.variables
+		parsed = self.parsed
+		if(parsed is None):
+			parsed = sorted(set(k for row in self.rows for k in row))
+		return columns+[k for k in parsed if k not in columns]
+
+	def writeRow(self, row):
+		"""Write a row to the .csv output. Must hold lock."""
+
+		if(self.writer is None):
+			self.writer = csv.DictWriter(self.out, fieldnames=self.header(), extrasaction='ignore')
+			self.writer.writeheader()
+		extra = set(row)-set(self.writer.fieldnames)-self.dropped
+		if(extra):
+			self.dropped |= extra
+			logInfo('Columns %s are not in the header of %s and are not collected', ', '.join(sorted(extra)), self.path)
+		self.writer.writerow(row)
+		self.out.flush()
+
+	@staticmethod
+	def columnArray(values):
+		"""Convert the values of a column to an array, with NaN (or '') for missing values"""
+
+		present = [v for v in values if v is not None]
+		if(all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present)):
+			if(len(present) == len(values) and all(isinstance(v, int) for v in present)):
+				return np.array(values, dtype=np.int64)
+			return np.array([np.nan if v is None else v for v in values], dtype=float)
+		return np.array(['' if v is None else str(v) for v in values])
+
+	def close(self):
+		"""Wait for the pending runs and complete the output"""
+
+		self.pool.shutdown(wait=True)
+		if(self.format == '.npz'):
+			np.savez(self.path, **dict((c, self.columnArray([row.get(c) for row in self.rows])) for c in self.header()))
+		else:
+			for row in self.rows:
+				self.writeRow(row)
+			self.out.close()
+		logInfo('Collected results of {:d} runs into {}'.format(self.nRows, self.path))
+
+#============================================
+# runKey: Hash of the resolved parameters of a
+# run, together with the resolved run directory,
+# commands and driver type
+#============================================
+def runKey(data):
+	"""Return a stable hash identifying a run by its resolved parameters"""
+
+	resolved = dict()
+	for name in data:
+		resolved[name] = evaluateStr(interpolateString(data[name], data))
+	resolved['%rundir'] = interpolateString(driverData['rundir'], data)
+	resolved['%type']   = driverData['type']
+	for phase, cmdStr in getRunCommands(data):
+		resolved['%'+phase] = cmdStr
+
+	encoded = json.dumps(resolved, sort_keys=True, default=str)
+	return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+#============================================
+# initLedger: Open the run ledger, if enabled
+#============================================
+def initLedger():
+	"""Open the persistent run ledger given by the 'ledger' driver parameter"""
+
+	global ledger
+	path = resolveAbsPath(interpolateString(driverData['ledger']))
+	if(path is not None):
+		ledger = RunLedger(path)
+
+def initResultCache():
+	"""Open the result cache given by the 'cache' driver parameter"""
+
+	global resultCache
+	path = resolveAbsPath(interpolateString(driverData['cache']))
+	if(path is not None):
+		resultCache = ResultCache(path, int(driverData['cachemb']*1024*1024))
+
+def initCollector():
+	"""Set up the collection of per-run results given by the postcollect section"""
+
+	global collector
+	if(collectData):
+		collector = ResultCollector(resolveAbsPath(interpolateString(collectData['output'])),
+		                            collectData['nworkers'], collectData['columns'])
+
+def initHistory():
+	"""Load the runtime history given by the 'history' driver parameter"""
+
+	global history
+	path = resolveAbsPath(interpolateString(driverData['history']))
+	if(path is not None):
+		history = RuntimeHistory(path)
+
+#============================================
+# RunResult: Outcome of a single run, reported
+# through the completion queue. Status is one of
+# skipped, prepared (directory set up but no
+# commands executed), succeeded or failed.
+# Phases holds the wall-clock time (and, for
+# commands, resource usage) of each phase.
+#============================================
+RunResult = namedtuple('RunResult', ['section', 'idx', 'workDir', 'status', 'returncodes', 'phases'])
+
+def runStatus(returncodes):
+	"""Return the status of a run given the (phase, returncode) pairs of its commands"""
+
+	if(any(rc != 0 for phase, rc in returncodes)):
+		return 'failed'
+	return 'succeeded'
+
+#============================================
+# reportCompletion: Report a finished run as
+# soon as it completes and add it to the
+# summary of the sweep
+#============================================
+def reportCompletion(result):
+	"""Log a completed run and record its status"""
+
+	runSummary[result.status] = runSummary.get(result.status, 0) + 1
+	if(logger.isEnabledFor(logging.INFO)):
+		codes = ', '.join('{}={}'.format(phase, rc) for phase, rc in result.returncodes)
+		logInfo('Run %s%s %s (%s)%s', result.section, list(result.idx), result.status,
+		        result.workDir, ' exit codes: '+codes if codes else '',
+		        extra={'fields': {'event': 'run', 'section': result.section, 'idx': list(result.idx),
+		                          'status': result.status, 'workdir': result.workDir,
+		                          'returncodes': dict(result.returncodes),
+		                          'value': result.phases.get('exec', {}).get('value')}})
+	if(tracer is not None):
+		tracer.record(result)
+	if(history is not None):
+		history.record(result)
+	if(collector is not None):
+		collector.submit(result)
+	if(result.status == 'failed' and len(failedRuns) < MAX_FAILED_REPORTS):
+		tails = [(phase, usage['tail']) for phase, usage in result.phases.items()
+		         if isinstance(usage, dict) and usage.get('tail')]
+		failedRuns.append((result.section, list(result.idx), result.workDir, tails))
+
+#============================================
+# prepareRun: Build the data of a run, consult
+# the ledger and set up its work directory.
+# Returns (data, key, workDir, result), where
+# the status of result is only set if no
+# commands should be executed for the run.
+#============================================
+def prepareRun(run):
+	"""Prepare a run for execution"""
+
+	section, idx = run
+	data = runSpaces[section].build(idx)
+	phases = {'start': time.time()}
+
+	key = None
+	if(ledger is not None):
+		key = runKey(data)
+		if(key in ledger.done):
+			logDebug('Run %s%s already succeeded according to ledger. Skipping this run.', section, list(idx))
+			return data, None, None, RunResult(section, idx, None, 'skipped', [], phases)
+
+		# Remove the partial work directory chauffeur created for a run which was interrupted
 		workDir = resolveAbsPath(interpolateString(driverData['rundir'],data))
+		if(ledger.interruptedCreated(key)):
+			removeIncompleteRun(workDir)
+		ledger.start(key, section, idx, workDir)
+
+	workDir = setupRun(data, phases)
+	if(workDir is None):
+		status = 'prepared' if (wetRun and driverData['type'] in ['param_only','setup']) else 'skipped'
+		return data, key, workDir, RunResult(section, idx, workDir, status, [], phases)
+
+	return data, key, workDir, RunResult(section, idx, workDir, None, [], phases)
+
+#============================================
+# removeIncompleteRun: Remove the partial work
+# directory left by an earlier, interrupted
+# attempt at a run, which would otherwise be
+# skipped as existing (skipifexist)
+#============================================
+def removeIncompleteRun(workDir):
+	"""Remove the work directory of an incomplete run, if it exists"""
+
+	if(driverData['templatedir'] and os.path.exists(workDir)):
+		logInfo('Removing work directory {:s} of incomplete run'.format(workDir))
+		shutil.rmtree(workDir)
+
+#============================================
+# restoreCachedRun / storeCachedRun: Consult the
+# result cache before executing the commands of
+# a run, and store its outputs if it succeeded.
+# The status of the returned result is 'cached'
+# if the outputs were restored from the cache.
+#============================================
+def restoreCachedRun(data, workDir, result):
+	"""Restore the outputs of a run from the result cache. Returns (cache key, result)"""
+
+	if(resultCache is None):
+		return None, result
+	tStart = time.time()
+	key = cacheKey(data, workDir)
+	if(resultCache.restore(key, workDir)):
+		logDebug('Restored outputs of run %s%s from result cache', result.section, list(result.idx))
+		result.phases['cache'] = {'wall': time.time()-tStart}
+		return key, result._replace(status='cached')
+	return key, result
+
+def storeCachedRun(key, data, workDir, result):
+	"""Store the outputs of a succeeded run in the result cache"""
+
+	if(key is not None and result.status == 'succeeded'):
+		resultCache.store(key, workDir, resultCacheOutputs(data))
+
+#============================================
+# finishRun: Record the outcome of a run in the
+# ledger and return its result
+#============================================
+def finishRun(key, result):
+	"""Record a finished run"""
+
+	result.phases['total'] = {'wall': time.time()-result.phases['start']}
+	recordLedger(key, result)
+	return result
+
+def recordLedger(key, result):
+	"""Record the final status of a run in the ledger, if enabled"""
+
+	if(key is not None):
+		status = {'prepared': 'succeeded', 'cached': 'succeeded'}.get(result.status, result.status)
+		ledger.finish(key, status, result.returncodes)
+
+#============================================
+# runCommand: Run a single command in the work
+# directory and wait for it. The child is reaped
+# with os.wait4 where available, so that its CPU
+# time and maximum resident set size can be
+# reported along with the wall-clock time.
+# If cpus is given, the command is started
+# through taskset, which binds itself to those
+# CPUs before executing it, so that everything
+# the command starts inherits the binding (a
+# preexec_fn is not safe to run in a process
+# with threads).
+#
+# A command with a timeout (or whose process
+# is passed to track, so that it can be killed
+# by another thread) is started in a session of
+# its own, and its whole process group is
+# killed once the timeout expires.
+#============================================
+def runCommand(cmdStr, workDir, cpus=None, env=None, stdout=None, stderr=None, timeout=None, track=None):
+	"""Run a command to completion, returning (returncode, usage)"""
+
+	args, shell = commandArgs(cmdStr)
+	if(cpus):
+		# taskset executes the command with execvp, which runs scripts without a shebang line with /bin/sh
+		args = ['taskset', '-c', ','.join(str(cpu) for cpu in cpus)]+(['/bin/sh', '-c', args] if shell else args)
+		shell = False
+	newSession = timeout is not None or track is not None
+	tStart = time.time()
+	popen = lambda args, shell: subprocess.Popen(args, shell=shell, cwd=workDir, env=env, stdout=stdout,
+	                                             stderr=stderr, start_new_session=newSession)
+	try:
+		try:
+			proc = popen(args, shell)
+		except OSError as e:
+			if(not shellFallback(e, shell)):
+				raise
+			proc = popen(cmdStr, True)
+	except OSError as e:
+		return startFailure(cmdStr, e, stderr, tStart)
+	if(newSession):
+		addSessionGroup(proc.pid)
+	if(track is not None):
+		track(proc.pid)
+
+	expired = threading.Event()
+	timer = None
+	if(timeout is not None):
+		def expire():
+			expired.set()
+			killGroup(proc.pid)
+		timer = threading.Timer(timeout, expire)
+		timer.daemon = True
+		timer.start()
+
+	usage = dict()
+	if(hasattr(os, 'wait4')):
+		pid, status, rusage = os.wait4(proc.pid, 0)
+		if(os.WIFSIGNALED(status)):
+			proc.returncode = -os.WTERMSIG(status)
+		else:
+			proc.returncode = os.WEXITSTATUS(status)
+		usage['utime']     = rusage.ru_utime
+		usage['stime']     = rusage.ru_stime
+		usage['maxrss_kb'] = rusage.ru_maxrss
+	else:
+		proc.wait()
+	if(timer is not None):
+		timer.cancel()
+	if(newSession):
+		removeSessionGroup(proc.pid)
+	if(track is not None):
+		track(None)
+	usage['wall'] = time.time()-tStart
+	usage['returncode'] = proc.returncode
+	if(expired.is_set()):
+		usage['timeout'] = timeout
+
+	return proc.returncode, usage
+
+#============================================
+# Session groups: commands started in a session
+# of their own no longer receive the SIGINT of
+# a Ctrl-C at the terminal. Their process groups
+# are registered while they run, SIGINT and
+# SIGTERM are forwarded to them, and those still
+# running when chauffeur exits are killed.
+#============================================
+sessionGroups     = set()
+sessionGroupsLock = threading.Lock()
+sessionClosing    = False
+
+def addSessionGroup(pid):
+	"""Register the process group led by pid, killing it if chauffeur is exiting"""
+
+	with sessionGroupsLock:
+		sessionGroups.add(pid)
+		closing = sessionClosing
+	if(closing):
+		try:
+			os.killpg(pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+def removeSessionGroup(pid):
+	"""Unregister the process group led by pid once it has been reaped"""
+
+	# While exiting, groups are kept until all of their processes are gone
+	with sessionGroupsLock:
+		if(not sessionClosing):
+			sessionGroups.discard(pid)
+
+def forwardSignal(signum, frame):
+	"""Forward SIGINT or SIGTERM to the registered process groups, then exit"""
+
+	global sessionClosing
+	with sessionGroupsLock:
+		sessionClosing = True
+		groups = list(sessionGroups)
+	for pid in groups:
+		try:
+			os.killpg(pid, signum)
+		except OSError:
+			pass
+	if(signum == signal.SIGINT):
+		raise KeyboardInterrupt
+	sys.exit(128+signum)
+
+def killSessionGroups():
+	"""Terminate, then kill, the process groups still registered at exit"""
+
+	global sessionClosing
+	with sessionGroupsLock:
+		sessionClosing = True
+		groups = list(sessionGroups)
+	for pid in groups:
+		try:
+			os.killpg(pid, signal.SIGTERM)
+		except OSError:
+			pass
+	deadline = time.time()+TIMEOUT_GRACE
+	while(groups and time.time() < deadline):
+		time.sleep(0.1)
+		groups = [pid for pid in groups if groupAlive(pid)]
+	for pid in groups:
+		try:
+			os.killpg(pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+def groupAlive(pid):
+	"""Whether any process of the group led by pid is still alive"""
+
+	try:
+		os.killpg(pid, 0)
+		return True
+	except OSError:
+		return False
+
+def initSignals():
+	"""Forward terminating signals to, and kill at exit, the process groups of commands"""
+
+	signal.signal(signal.SIGINT, forwardSignal)
+	signal.signal(signal.SIGTERM, forwardSignal)
+	atexit.register(killSessionGroups)
+
+#============================================
+# killGroup: Terminate the process group led by
+# pid, and kill it if any of its processes are
+# still alive TIMEOUT_GRACE seconds later
+#============================================
+def killGroup(pid):
+	"""Terminate, then kill, the process group led by pid"""
+
+	try:
+		os.killpg(pid, signal.SIGTERM)
+		deadline = time.time()+TIMEOUT_GRACE
+		while(time.time() < deadline):
+			time.sleep(0.1)
+			os.killpg(pid, 0)
+		os.killpg(pid, signal.SIGKILL)
+	except OSError:
+		pass
+
+def killGroupBackground(pid):
+	"""Kill the process group led by pid from a separate thread"""
+
+	thread = threading.Thread(target=killGroup, args=(pid,), name='kill-{:d}'.format(pid))
+	thread.daemon = True
+	thread.start()
+
+#============================================
+# Timeouts and retries: each phase may have a
+# timeout (pretimeout, exectimeout, posttimeout,
+# in seconds), after which the process group of
+# its command is killed and the command fails.
+# A failed command is retried up to 'retries'
+# times, waiting retrybackoff seconds before
+# the first retry and doubling the wait before
+# each further one.
+#============================================
+def phaseTimeout(phase):
+	"""Timeout of the command of a phase in seconds, or None"""
+
+	timeout = driverData[phase+'timeout']
+	return float(timeout) if timeout is not None else None
+
+def retryDelay(phase, workDir, usage, attempt):
+	"""Log a failed attempt of a phase and return the delay before it is retried"""
+
+	delay = driverData['retrybackoff']*2**(attempt-1)
+	logInfo('%s command in %s failed (exit code %s), retrying in %gs (%d/%d)', phase, workDir,
+	        usage['returncode'], delay, attempt, int(driverData['retries']))
+	return delay
+
+def logTimeout(phase, workDir, usage):
+	"""Log a command which was killed after exceeding its timeout"""
+
+	if(usage.get('timeout') is not None):
+		logInfo('%s command in %s timed out after %gs', phase, workDir, usage['timeout'])
+
+#============================================
+# runPhase: Execute the command of one phase of
+# a run (with the threads engine), subject to
+# its timeout and retries. With spec, the run
+# may be executed by two copies (see Speculator)
+# and who names the copy executing the phase.
+#============================================
+def runPhase(phase, cmdStr, data, workDir, streams, cpus=None, spec=None, who=None):
+	"""Execute a phase of a run, returning (returncode, usage)"""
+
+	timeout = phaseTimeout(phase)
+	track = functools.partial(spec.track, who) if spec is not None else None
+	retries = int(driverData['retries'])
+	for attempt in range(retries+1):
+		logDebug('Executing %s command: %s', phase, cmdStr)
+		if(phase == 'exec' and driverData['type'] == 'python'):
+			returncode, usage = runPython(cmdStr, data, workDir, streams)
+		else:
+			returncode, usage = runCommand(cmdStr, workDir, cpus, stdout=streams[0], stderr=streams[1],
+			                               timeout=timeout, track=track)
+			if(returncode != 0):
+				usage['tail'] = outputTail(streams)
+		logTimeout(phase, workDir, usage)
+		if(returncode == 0 or attempt == retries or (spec is not None and spec.lost(who))):
+			break
+		time.sleep(retryDelay(phase, workDir, usage, attempt+1))
+	if(attempt > 0):
+		usage['attempts'] = attempt+1
+	return returncode, usage
+
+#============================================
+# Output capture: with the 'stdout' and/or
+# 'stderr' driver parameters set, the output of
+# a run's commands is written to those files in
+# its work directory (opened once per run, so
+# all phases are appended in order) rather than
+# inherited from chauffeur. Children write to
+# the files directly, so no pipe can fill up and
+# stall them, and outputs of concurrent runs do
+# not interleave. When a command fails, the last
+# tailkb KB of its output are kept with its
+# usage, to be reported at the end of the sweep.
+#============================================
+def openRunLogs(data, workDir):
+	"""Open the files capturing the output of a run. Returns (stdout, stderr)"""
+
+	files = dict()
+	streams = []
+	for key in ['stdout', 'stderr']:
+		if(driverData[key] is None):
+			streams.append(None)
+			continue
+		path = os.path.join(workDir, interpolateString(driverData[key], data))
+		if(path not in files):
+			# Truncate, then append: children of later phases write at the end
+			open(path, 'wb').close()
+			files[path] = open(path, 'ab')
+		streams.append(files[path])
+	return tuple(streams)
+
+def closeRunLogs(streams):
+	"""Close the files opened by openRunLogs"""
+
+	for stream in set(s for s in streams if s is not None):
+		stream.close()
 
-		# If the workDir exists, skip this run
-		if(driverData['skipifexist'] and driverData['templatedir'] and os.path.exists(workDir)):
-			logInfo('Work directory {:s} exists. Skipping this run.'.format(workDir))
-			continue
+def outputTail(streams):
+	"""Return the last tailkb KB of the captured output of a run (stderr preferred)"""
+
+	stream = streams[1] if streams[1] is not None else streams[0]
+	if(stream is None):
+		return None
+	stream.flush()
+	nBytes = int(driverData['tailkb']*1024)
+	with open(stream.name, 'rb') as f:
+		f.seek(0, os.SEEK_END)
+		offset = max(0, f.tell()-nBytes)
+		f.seek(offset)
+		tail = f.read(nBytes)
+	# Drop the partial first line of a truncated tail
+	if(offset > 0 and b'\n' in tail[:-1]):
+		tail = tail[tail.index(b'\n')+1:]
+	return tail.decode('utf-8', 'replace')
+
+#============================================
+# Python execution: with 'type: python', the
+# execcommand of a run names a Python callable
+# as "module:function" (or "path/to/file.py:
+# function"), which is called with the run's
+# resolved parameters as keyword arguments in a
+# pool of warm worker processes, instead of
+# starting a new process for every run. Only
+# the parameters the function accepts are
+# passed, unless it takes **kwargs. The pool
+# processes run one call at a time, in the
+# run's work directory and with their output
+# redirected to the run's stdout/stderr files.
+# With pyrecycle, the pool is replaced by a new
+# one after pyrecycle calls per process. The return value is
+# kept with the usage of the exec phase (and
+# written to returnfile, if set); an exception
+# fails the run, with its traceback as tail.
+#============================================
+pythonPool     = None
+pythonPoolLock = threading.Lock()
+pythonCalls    = 0
+pythonModules  = dict()
+
+def initPythonWorker(cwd):
+	"""Initialize a pool process, making modules in the driver's directory importable"""
+
+	sys.path.insert(0, cwd)
+
+def resolvePython(target):
+	"""Return the callable named by a module:function target (in a pool process)"""
+
+	module, sep, name = target.rpartition(':')
+	if(not sep or not module or not name):
+		raise ValueError('Python target "{}" is not of the form module:function'.format(target))
+	if(module not in pythonModules):
+		if(module.endswith('.py') or os.sep in module):
+			spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(module))[0], module)
+			pythonModules[module] = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(pythonModules[module])
+		else:
+			pythonModules[module] = importlib.import_module(module)
+	return getattr(pythonModules[module], name)
+
+def callPython(target, kwargs, workDir, stdoutPath=None, stderrPath=None):
+	"""Call a Python target in a pool process. Returns (returncode, value, error)"""
+
+	cwd = os.getcwd()
+	saved = []
+	try:
+		for fd, path in ((1, stdoutPath), (2, stderrPath)):
+			if(path is not None):
+				sys.stdout.flush()
+				sys.stderr.flush()
+				saved.append((fd, os.dup(fd)))
+				logFd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+				os.dup2(logFd, fd)
+				os.close(logFd)
+		os.chdir(workDir)
+
+		func = resolvePython(target)
+		params = inspect.signature(func).parameters.values()
+		if(not any(p.kind == p.VAR_KEYWORD for p in params)):
+			names = {p.name for p in params}
+			kwargs = dict((k, v) for k, v in kwargs.items() if k in names)
+		return 0, func(**kwargs), None
+	except Exception:
+		return 1, None, traceback.format_exc()
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		for fd, dupFd in saved:
+			os.dup2(dupFd, fd)
+			os.close(dupFd)
+		os.chdir(cwd)
+
+def submitPython(*args):
+	"""Submit a Python call to the process pool, starting or recycling it as needed"""
+
+	global pythonPool, pythonCalls
+	# Calls are submitted under the lock, so a pool is never retired between
+	# a thread obtaining it and submitting to it
+	with pythonPoolLock:
+		nWorkers = int(driverData['pyworkers'] or os.cpu_count() or 1)
+		recycle = driverData['pyrecycle']
+		if(pythonPool is not None and recycle and pythonCalls >= int(recycle)*nWorkers):
+			# Retire the pool once it has served pyrecycle calls per process on
+			# average; its calls in progress complete before its processes exit
+			pythonPool.shutdown(wait=False)
+			pythonPool = None
+		for attempt in range(2):
+			if(pythonPool is None):
+				pythonPool = concurrent.futures.ProcessPoolExecutor(max_workers=nWorkers,
+					mp_context=multiprocessing.get_context('spawn'),
+					initializer=initPythonWorker, initargs=(os.getcwd(),))
+				pythonCalls = 0
+				logDebug('Started %d Python worker processes', nWorkers)
+			try:
+				future = pythonPool.submit(callPython, *args)
+				break
+			except concurrent.futures.process.BrokenProcessPool:
+				# A worker process died since the last call; start a new pool
+				if(attempt):
+					raise
+				pythonPool.shutdown(wait=False)
+				pythonPool = None
+		pythonCalls += 1
+		return pythonPool, future
+
+def discardPythonPool(pool):
+	"""Replace a broken process pool (e.g. after a worker process was killed)"""
+
+	global pythonPool
+	with pythonPoolLock:
+		if(pythonPool is pool):
+			pythonPool.shutdown(wait=False)
+			pythonPool = None
+
+def pythonValue(value, data, nCalls=0):
+	"""Resolve a parameter for a Python call, keeping the type of a single parameter or expression"""
+
+	if(not isinstance(value,str)):
+		return value
+	segments = compileTemplate(value)
+	if(len(segments) == 1 and not isinstance(segments[0], str) and segments[0].inlineFmt is None and nCalls < MAX_RECURS):
+		raw = lookupParameter(segments[0].name, data)
+		if(raw is not None):
+			return pythonValue(raw, data, nCalls+1)
+	return evaluateStr(interpolateString(value, data))
+
+def pythonKwargs(data, workDir):
+	"""Resolve the parameters of a run into keyword arguments"""
+
+	kwargs = dict((name, pythonValue(data[name], data)) for name in data)
+	kwargs['workdir'] = workDir
+	return kwargs
+
+def runPython(target, data, workDir, streams=(None, None)):
+	"""Call the Python target of a run in the process pool, returning (returncode, usage)"""
+
+	module, sep, name = target.rpartition(':')
+	if(module.endswith('.py') or os.sep in module):
+		target = resolveAbsPath(module)+sep+name
+	for stream in streams:
+		if(stream is not None):
+			stream.flush()
+
+	tStart = time.time()
+	pool, future = submitPython(target, pythonKwargs(data, workDir), workDir,
+	                            *[s.name if s is not None else None for s in streams])
+	try:
+		returncode, value, error = future.result()
+	except concurrent.futures.process.BrokenProcessPool as e:
+		# Only the calls in progress fail; later calls start a new pool
+		discardPythonPool(pool)
+		returncode, value, error = 1, None, 'Python worker process terminated abruptly: {}\n'.format(e)
+	usage = {'wall': time.time()-tStart, 'returncode': returncode}
+	if(error is not None):
+		usage['tail'] = error
+	else:
+		usage['value'] = value
+		if(driverData['returnfile'] is not None):
+			returnFile = os.path.join(workDir, interpolateString(driverData['returnfile'], data))
+			writeIfChanged(returnFile, json.dumps(value, default=str)+'\n')
+	return returncode, usage
+
+#============================================
+# Speculative execution: with 'speculate: k', a
+# run whose commands have been running for more
+# than k times the median runtime of the runs
+# completed so far (once SPECULATE_MIN_RUNS have
+# succeeded) is started again by a duplicate, in
+# a fresh directory next to its work directory
+# which is populated from templatedir and the
+# run's file* outputs. The first copy to finish
+# wins and the other is killed; a duplicate
+# which fails is discarded. If the duplicate
+# wins, its directory replaces the work
+# directory of the run.
+#============================================
+class SpeculativeRun(object):
+	"""A run which may be executed by its original thread and a duplicate"""
+
+	def __init__(self, data, result, workDir, commands):
+		self.data     = data
+		self.result   = result
+		self.workDir  = workDir
+		self.specDir  = workDir+SPECULATE_SUFFIX
+		self.commands = commands
+		self.start    = time.time()
+		self.lock     = threading.Lock()
+		self.pids     = {'original': None, 'duplicate': None}
+		self.winner   = None
+		self.thread   = None
+		self.outcome  = None
+
+	def track(self, who, pid):
+		"""Record the process executed by a copy, killing it if the copy already lost"""
+
+		with self.lock:
+			self.pids[who] = pid
+			lost = self.winner not in (None, who)
+		if(lost and pid is not None):
+			killGroupBackground(pid)
 
+	def lost(self, who):
+		with self.lock:
+			return self.winner not in (None, who)
 
-		templateDir = resolveAbsPath(interpolateString(driverData['templatedir'],data))
+	def finish(self, who):
+		"""Claim the run for a copy which finished, killing the other one. Returns the winner."""
+
+		with self.lock:
+			if(self.winner is None):
+				self.winner = who
+				pid = self.pids['duplicate' if who == 'original' else 'original']
+				if(pid is not None):
+					killGroupBackground(pid)
+			return self.winner
+
+class Speculator(object):
+	"""Watches the runs being executed and starts duplicates of stragglers"""
+
+	def __init__(self, factor):
+		self.factor    = float(factor)
+		self.lock      = threading.Lock()
+		self.durations = []
+		self.running   = set()
+		thread = threading.Thread(target=self.monitor, name='speculator')
+		thread.daemon = True
+		thread.start()
+
+	def register(self, data, result, workDir, commands):
+		"""Start watching a run whose commands are about to be executed"""
+
+		spec = SpeculativeRun(data, result, workDir, commands)
+		with self.lock:
+			self.running.add(spec)
+		return spec
+
+	def monitor(self):
+		"""Periodically start duplicates of runs exceeding the runtime threshold"""
+
+		while True:
+			time.sleep(SPECULATE_INTERVAL)
+			with self.lock:
+				if(len(self.durations) < SPECULATE_MIN_RUNS):
+					continue
+				threshold = self.factor*self.durations[len(self.durations)//2]
+				now = time.time()
+				for spec in self.running:
+					if(spec.thread is None and now-spec.start > threshold):
+						spec.thread = threading.Thread(target=runDuplicate, args=(spec,), name='duplicate')
+						spec.thread.daemon = True
+						spec.thread.start()
+
+	def complete(self, spec, result):
+		"""Settle a run once its original copy finished, adopting the duplicate's outcome if it won"""
+
+		with self.lock:
+			self.running.discard(spec)
+		if(spec.finish('original') == 'duplicate'):
+			spec.thread.join()
+			returncodes, phases = spec.outcome
+			straggler = spec.workDir+'.straggler'
+			os.rename(spec.workDir, straggler)
+			os.rename(spec.specDir, spec.workDir)
+			shutil.rmtree(straggler, ignore_errors=True)
+			for usage in phases.values():
+				usage['speculative'] = True
+			result.returncodes[:] = returncodes
+			result.phases.update(phases)
+			logInfo('Run %s%s completed by its duplicate', result.section, list(result.idx))
+		elif(spec.thread is not None):
+			spec.thread.join()
+		if(runStatus(result.returncodes) == 'succeeded'):
+			with self.lock:
+				bisect.insort(self.durations, time.time()-spec.start)
+
+def runDuplicate(spec):
+	"""Execute the commands of a straggling run again in a fresh directory"""
+
+	section, idx = spec.result.section, list(spec.result.idx)
+	logInfo('Run %s%s exceeded the expected runtime. Starting a duplicate in %s', section, idx, spec.specDir)
+	won = False
+	try:
+		if(os.path.lexists(spec.specDir)):
+			shutil.rmtree(spec.specDir)
+		templateDir = resolveAbsPath(interpolateString(driverData['templatedir'], spec.data))
+		realCopies = templateRealCopies(spec.data, spec.workDir)
 		if(templateDir is not None):
-			logInfo('Copying %s to %s'%(templateDir,workDir))
-			if(wetRun):
-				shutil.copytree(templateDir,workDir,symlinks=True)
+			materializeTemplate(templateDir, spec.specDir, driverData['templatemode'], realCopies)
+		else:
+			os.makedirs(spec.specDir)
+		for relPath in realCopies:
+			dst = os.path.join(spec.specDir, relPath)
+			os.makedirs(os.path.dirname(dst), exist_ok=True)
+			shutil.copy2(os.path.join(spec.workDir, relPath), dst)
 
-		if(wetRun):
+		returncodes, phases = [], dict()
+		streams = openRunLogs(spec.data, spec.specDir)
+		try:
+			for phase, cmdStr in spec.commands:
+				if(spec.lost('duplicate')):
+					return
+				returncode, usage = runPhase(phase, cmdStr, spec.data, spec.specDir, streams, spec=spec, who='duplicate')
+				returncodes.append((phase, returncode))
+				phases[phase] = usage
+		finally:
+			closeRunLogs(streams)
+
+		if(runStatus(returncodes) == 'succeeded'):
+			spec.outcome = (returncodes, phases)
+			won = spec.finish('duplicate') == 'duplicate'
+		else:
+			logInfo('Duplicate of run %s%s failed', section, idx)
+	except OSError as e:
+		logInfo('Duplicate of run %s%s could not be started: %s', section, idx, e)
+	finally:
+		if(not won):
+			shutil.rmtree(spec.specDir, ignore_errors=True)
 
-			# Ensure that run directory exists. If not, create it.
-			if(not os.path.exists(workDir)):
-				logInfo('Creating run directory %s'%workDir)
-				path = Path(workDir)
-				path.mkdir(parents=True)
+#============================================
+# executeRun: Set up a run and execute its
+# commands in the calling thread
+#============================================
+def executeRun(run, cpus=None):
+	"""Execute the driver specifications for a single run and return its RunResult"""
 
-			# Process files
-			processFiles(data)
+	data, key, workDir, result = prepareRun(run)
+	if(result.status is not None):
+		return finishRun(key, result)
 
-			if(driverData['type'] in ['param_only','setup']):
-				continue
+	cached, result = restoreCachedRun(data, workDir, result)
+	if(result.status is not None):
+		return finishRun(key, result)
+
+	# Run pre, exec and post commands in working directory
+	commands = getRunCommands(data)
+	spec = None
+	if(speculator is not None):
+		spec = speculator.register(data, result, workDir, commands)
+	streams = openRunLogs(data, workDir)
+	try:
+		for phase, cmdStr in commands:
+			returncode, usage = runPhase(phase, cmdStr, data, workDir, streams, cpus, spec, 'original')
+			result.returncodes.append((phase, returncode))
+			result.phases[phase] = usage
+			if(spec is not None and spec.lost('original')):
+				break
+	finally:
+		closeRunLogs(streams)
+	if(spec is not None):
+		speculator.complete(spec, result)
+
+	result = result._replace(status=runStatus(result.returncodes))
+	storeCachedRun(cached, data, workDir, result)
+	return finishRun(key, result)
+
+#============================================
+# worker: Function called for each thread.
+# Pulls a set of data off the run queue
+# (from the cartesian product) and executes
+# relevant activities. Each finished run is
+# put on the completion queue, followed by a
+# final None once the thread exits.
+#============================================
+def worker():
+	"""Execute the driver specifications for a given set of parameters (threaded)"""
+
+	try:
+		while True:
+			item = runqueue.get()
+			if item is None:
+				return
+			run, grant = item
+			try:
+				try:
+					result = executeRun(run, grant[2] if grant else None)
+				except (Exception, SystemExit):
+					result = crashedResult(run)
+				completeRun(result)
+			finally:
+				if(grant is not None):
+					resourcePool.release(grant)
+	finally:
+		completions.put(None)
+
+#============================================
+# crashedResult: Result of a run whose execution
+# raised an exception (or aborted, which raises
+# SystemExit). The run is reported as
+# failed (with the traceback as its output), so
+# that the runs depending on it are released.
+#============================================
+def crashedResult(run):
+	"""Return a failed RunResult for the exception being handled"""
+
+	error = traceback.format_exc()
+	logger.error('Run %s%s raised an exception:\n%s', run[0], list(run[1]), error.rstrip('\n'))
+	return finishRun(None, RunResult(run[0], run[1], None, 'failed', [], {'start': time.time(), 'error': {'wall': 0.0, 'tail': error}}))
+
+#============================================
+# completeRun: Hand a finished run to the main
+# thread for reporting, and release the runs
+# depending on it
+#============================================
+def completeRun(result):
+	"""Report a finished run"""
+
+	completions.put(result)
+	if(dependencies is not None):
+		dependencies.finish(result)
+
+#============================================
+# Pipelined execution: with 'pipeline' set, the
+# setup (template copy, files and result cache),
+# pre, exec and post stages of runs are executed
+# by separate pools of threads, each with its
+# own number of threads (nthreads by default),
+# e.g. many threads for I/O-bound setup and one
+# exec thread per core. Runs flow from stage to
+# stage through bounded queues, so the setup of
+# later runs overlaps with the execution of
+# earlier ones. A run skips stages without a
+# command. As with executeRun, the later
+# commands of a run are executed even if an
+# earlier one fails.
+#============================================
+class StagedRun(object):
+	"""State of a run passing through the pipeline"""
+
+	def __init__(self, run):
+		self.run      = run
+		self.data     = None
+		self.key      = None
+		self.cached   = None
+		self.workDir  = None
+		self.result   = None
+		self.commands = dict()
+		self.streams  = (None, None)
+
+class Pipeline(object):
+	"""Pools of threads executing the stages of runs, connected by queues"""
+
+	def __init__(self, limits):
+		self.limits  = [int(limits.get(stage, driverData['nthreads'])) for stage in PIPELINE_STAGES]
+		self.queues  = [queue.Queue(maxsize=RUN_QUEUE_DEPTH*n) for n in self.limits]
+		self.running = list(self.limits)
+		self.lock    = threading.Lock()
+		self.threads = []
+		for i, stage in enumerate(PIPELINE_STAGES):
+			for j in range(self.limits[i]):
+				thread = threading.Thread(target=self.work, args=(i,), name='{}-{:02d}'.format(stage, j))
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+
+	def work(self, i):
+		"""Execute stage i of the runs in its queue until its final None"""
+
+		try:
+			while True:
+				item = self.queues[i].get()
+				if item is None:
+					return
+				staged = StagedRun(item[0]) if i == 0 else item
+				try:
+					if(i == 0):
+						self.setup(staged)
+					else:
+						self.execute(i, staged)
+				except (Exception, SystemExit):
+					closeRunLogs(staged.streams)
+					completeRun(crashedResult(staged.run))
+		finally:
+			# The last thread of a stage to exit passes the end of the runs on
+			with self.lock:
+				self.running[i] -= 1
+				last = self.running[i] == 0
+			if(last and i+1 < len(PIPELINE_STAGES)):
+				for _j in range(self.limits[i+1]):
+					self.queues[i+1].put(None)
+			if(i+1 == len(PIPELINE_STAGES)):
+				completions.put(None)
+
+	def setup(self, staged):
+		"""Prepare the work directory of a run"""
+
+		staged.data, staged.key, staged.workDir, staged.result = prepareRun(staged.run)
+		if(staged.result.status is None):
+			staged.cached, staged.result = restoreCachedRun(staged.data, staged.workDir, staged.result)
+		if(staged.result.status is None):
+			staged.commands = dict(getRunCommands(staged.data))
+			staged.streams = openRunLogs(staged.data, staged.workDir)
+		self.advance(0, staged)
+
+	def execute(self, i, staged):
+		"""Execute the command of stage i of a run"""
+
+		phase = PIPELINE_STAGES[i]
+		returncode, usage = runPhase(phase, staged.commands[phase], staged.data, staged.workDir, staged.streams)
+		staged.result.returncodes.append((phase, returncode))
+		staged.result.phases[phase] = usage
+		self.advance(i, staged)
+
+	def advance(self, i, staged):
+		"""Pass a run on to the next stage with a command, or finish it"""
+
+		if(staged.result.status is None):
+			for j in range(i+1, len(PIPELINE_STAGES)):
+				if(PIPELINE_STAGES[j] in staged.commands):
+					self.queues[j].put(staged)
+					return
+		self.finish(staged)
+
+	def finish(self, staged):
+		"""Record the outcome of a run leaving the pipeline"""
+
+		closeRunLogs(staged.streams)
+		result = staged.result
+		if(result.status is None):
+			result = result._replace(status=runStatus(result.returncodes))
+			storeCachedRun(staged.cached, staged.data, staged.workDir, result)
+		completeRun(finishRun(staged.key, result))
+
+#============================================
+# collectCompletions: Report runs from the
+# completion queue as they finish, until each
+# of nProducers has put its final None
+#============================================
+def collectCompletions(nProducers):
+	"""Report completed runs until all producers are finished"""
+
+	while(nProducers > 0):
+		result = completions.get()
+		if(result is None):
+			nProducers -= 1
+			continue
+		reportCompletion(result)
+
+#============================================
+# feedRuns: Push all runs onto the (bounded)
+# run queue, followed by one EOF marker for
+# each worker thread
+#============================================
+def feedRuns(runs, nWorkers):
+	"""Stream runs into the run queue"""
+
+	try:
+		for run in runs:
+			runqueue.put((run, None))
+	except BaseException:
+		feedFailure()
+	finally:
+		for _i in range(nWorkers):
+			runqueue.put(None)
+
+#============================================
+# feedFailure: Record that the feeder thread
+# failed, e.g. on a cost or request which
+# does not evaluate. The feeder still queues
+# its EOF markers, so that the threads finish
+# the runs already queued, after which the
+# sweep exits with an error.
+#============================================
+def feedFailure():
+	"""Report the exception being handled in the feeder thread"""
+
+	global feedFailed
+
+	feedFailed = True
+	# abort() has already logged its message before raising SystemExit
+	if(not isinstance(sys.exc_info()[1], SystemExit)):
+		logger.critical('Queueing runs failed:\n%s', traceback.format_exc().rstrip('\n'))
+
+#============================================
+# Resource-aware scheduling: each run requests
+# a number of cores and an amount of memory
+# (the 'cores' and 'mem_gb' keys of its run
+# section), and runs are only started while
+# their request fits in the remaining capacity
+# of the node (maxcores, maxmem_gb).
+#   firstfit - runs start in order; a run
+#              which does not fit blocks the
+#              runs behind it
+#   backfill - later runs within a window of
+#              BACKFILL_WINDOW pending runs may
+#              start ahead of a run which does
+#              not fit. The first pending run
+#              can only be passed over as many
+#              times as the window is long,
+#              after which the node is drained
+#              for it.
+# With pinning, each run is given its own set
+# of CPUs, which its commands are bound to.
+#============================================
+class ResourcePool(object):
+	"""Cores, memory and (optionally) CPUs available to runs"""
+
+	def __init__(self, cores, memGb, cpus=None):
+		self.cores    = cores
+		self.memGb    = memGb
+		self.freeCores = cores
+		self.freeMemGb = memGb
+		self.freeCpus  = sorted(cpus) if cpus is not None else None
+		self.cond = threading.Condition()
+
+	def clamp(self, request):
+		"""Limit a request to the capacity of the pool"""
+
+		cores, memGb = request
+		return min(cores, self.cores), (min(memGb, self.memGb) if self.memGb is not None else memGb)
+
+	def fits(self, request):
+		"""Whether a request can be granted now. Must hold cond."""
+
+		cores, memGb = request
+		return cores <= self.freeCores and (self.memGb is None or memGb <= self.freeMemGb)
+
+	def acquire(self, request):
+		"""Grant a request which fits. Must hold cond. Returns (cores, memGb, cpus)"""
+
+		cores, memGb = request
+		self.freeCores -= cores
+		if(self.memGb is not None):
+			self.freeMemGb -= memGb
+		cpus = None
+		if(self.freeCpus is not None):
+			cpus, self.freeCpus = self.freeCpus[:cores], self.freeCpus[cores:]
+		return cores, memGb, cpus
+
+	def release(self, grant):
+		"""Return a granted request to the pool"""
+
+		cores, memGb, cpus = grant
+		with self.cond:
+			self.freeCores += cores
+			if(self.memGb is not None):
+				self.freeMemGb += memGb
+			if(cpus is not None):
+				self.freeCpus = sorted(self.freeCpus + cpus)
+			self.cond.notify_all()
+
+def initResourcePool():
+	"""Create the resource pool used by the scheduler from the driver capacity"""
+
+	global resourcePool
+
+	cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+	cores = driverData['maxcores']
+	if(cores is None):
+		cores = len(cpus) if cpus is not None else (os.cpu_count() or 1)
+	memGb = driverData['maxmem_gb']
+	if(memGb is None and hasattr(os, 'sysconf')):
+		try:
+			memGb = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2.0**30
+		except (ValueError, OSError):
+			memGb = None
+
+	if(driverData['pinning']):
+		if(cpus is None):
+			abort('CPU pinning is not supported on this platform')
+		if(shutil.which('taskset') is None):
+			abort('CPU pinning requires taskset (util-linux)')
+		if(cores > len(cpus)):
+			abort('Cannot pin {:d} cores to the {:d} available CPUs'.format(cores, len(cpus)))
+		cpus = cpus[:cores]
+	else:
+		cpus = None
+
+	resourcePool = ResourcePool(int(cores), memGb, cpus)
+	logInfo('Scheduling runs on {:d} cores{} ({})'.format(resourcePool.cores,
+		'' if memGb is None else ' and {:.1f} GB of memory'.format(memGb), driverData['scheduler']))
+
+def runResources(section, idx):
+	"""Evaluate the (cores, mem_gb) request of a single run"""
+
+	request = []
+	data = None
+	for key, default in RESOURCE_KEYS:
+		value = runData[section].get(key, default)
+		if(isinstance(value,str)):
+			if(data is None):
+				data = runSpaces[section].build(idx)
+			value = evaluateStr(interpolateString(value, data))
+		value = float(value)
+		if(value < 0):
+			abort('Negative {} {} for run {}{}'.format(key, value, section, list(idx)))
+		request.append(value)
+
+	cores, memGb = int(ceil(request[0])), request[1]
+	clamped = resourcePool.clamp((cores, memGb))
+	if(clamped != (cores, memGb) and section not in resourceWarnings):
+		resourceWarnings.add(section)
+		logger.warning('Runs of section "{}" request more cores or memory than available, and are limited to the capacity of the node'.format(section))
+	return clamped
+
+def scheduleRuns(runs, nWorkers):
+	"""Stream runs into the run queue as resources become available"""
+
+	try:
+		runs = iter(runs)
+		window = deque()
+		windowSize = BACKFILL_WINDOW if driverData['scheduler'] == 'backfill' else 1
+		passes = 0
+
+		while(True):
+			while(len(window) < windowSize):
+				run = next(runs, None)
+				if(run is None):
+					break
+				window.append((run, runResources(*run)))
+			if(not window):
+				break
+
+			with resourcePool.cond:
+				while(True):
+					candidates = range(len(window)) if passes < windowSize else range(1)
+					choice = next((i for i in candidates if resourcePool.fits(window[i][1])), None)
+					if(choice is not None):
+						break
+					resourcePool.cond.wait()
+				run, request = window[choice]
+				del window[choice]
+				passes = passes+1 if choice > 0 else 0
+				grant = resourcePool.acquire(request)
+
+			runqueue.put((run, grant))
+	except BaseException:
+		feedFailure()
+	finally:
+		for _i in range(nWorkers):
+			runqueue.put(None)
+
+#============================================
+# asyncRunPhase: Run the command of a phase as
+# an asyncio subprocess, subject to the same
+# timeout and retries as runPhase. A command
+# which times out has its process group killed.
+#============================================
+async def asyncRunPhase(phase, cmdStr, data, workDir, streams):
+	"""Execute a phase of a run subject to its timeout and retries, returning (returncode, usage)"""
+
+	loop = asyncio.get_event_loop()
+	timeout = phaseTimeout(phase)
+	retries = int(driverData['retries'])
+	for attempt in range(retries+1):
+		logDebug('Executing %s command: %s', phase, cmdStr)
+		if(phase == 'exec' and driverData['type'] == 'python'):
+			returncode, usage = await loop.run_in_executor(None, runPython, cmdStr, data, workDir, streams)
+		else:
+			# Only wall-clock time is traced: asyncio reaps its children itself
+			tStart = time.time()
+			usage = dict()
+			args, shell = commandArgs(cmdStr)
+			kwargs = dict(cwd=workDir, stdout=streams[0], stderr=streams[1], start_new_session=timeout is not None)
+			try:
+				try:
+					if(shell):
+						proc = await asyncio.create_subprocess_shell(args, **kwargs)
+					else:
+						proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+				except OSError as e:
+					if(not shellFallback(e, shell)):
+						raise
+					proc = await asyncio.create_subprocess_shell(cmdStr, **kwargs)
+			except OSError as e:
+				returncode, usage = startFailure(cmdStr, e, streams[1], tStart)
+			else:
+				if(timeout is not None):
+					addSessionGroup(proc.pid)
+				try:
+					returncode = await asyncio.wait_for(proc.wait(), timeout)
+				except asyncio.TimeoutError:
+					usage['timeout'] = timeout
+					killGroupBackground(proc.pid)
+					returncode = await proc.wait()
+				if(timeout is not None):
+					removeSessionGroup(proc.pid)
+				usage['wall'] = time.time()-tStart
+				usage['returncode'] = returncode
+			if(returncode != 0):
+				usage['tail'] = outputTail(streams)
+		logTimeout(phase, workDir, usage)
+		if(returncode == 0 or attempt == retries):
+			break
+		await asyncio.sleep(retryDelay(phase, workDir, usage, attempt+1))
+	if(attempt > 0):
+		usage['attempts'] = attempt+1
+	return returncode, usage
+
+#============================================
+# asyncExecuteRun: Execute a single run with
+# the asyncio engine. Directory setup and file
+# processing are performed in the default
+# executor; commands are run as asyncio
+# subprocesses in the work directory.
+#============================================
+async def asyncExecuteRun(run):
+	"""Execute the driver specifications for a single run and return its RunResult (asyncio)"""
+
+	loop = asyncio.get_event_loop()
+
+	data, key, workDir, result = await loop.run_in_executor(None, prepareRun, run)
+	if(result.status is not None):
+		return finishRun(key, result)
+
+	cached, result = await loop.run_in_executor(None, restoreCachedRun, data, workDir, result)
+	if(result.status is not None):
+		return finishRun(key, result)
+
+	streams = openRunLogs(data, workDir)
+	try:
+		for phase, cmdStr in getRunCommands(data):
+			returncode, usage = await asyncRunPhase(phase, cmdStr, data, workDir, streams)
+			result.returncodes.append((phase, returncode))
+			result.phases[phase] = usage
+	finally:
+		closeRunLogs(streams)
+
+	result = result._replace(status=runStatus(result.returncodes))
+	await loop.run_in_executor(None, storeCachedRun, cached, data, workDir, result)
+	return finishRun(key, result)
+
+#============================================
+# asyncWorker: Execute a single run with the
+# asyncio engine. A run which raises (or
+# aborts) is reported as failed, as with the
+# threads engine.
+#============================================
+async def asyncWorker(run):
+	"""Execute the driver specifications for a single run (asyncio)"""
+
+	try:
+		return await asyncExecuteRun(run)
+	except (Exception, SystemExit):
+		return crashedResult(run)
+
+#============================================
+# runAsyncEngine: Drive all runs through the
+# asyncio engine. The number of runs in flight
+# is capped by a semaphore of size nconcurrent,
+# and runs are only pulled from the run stream
+# as slots become available. Runs are reported
+# as soon as they complete.
+#============================================
+async def runAsyncEngine(runs):
+	"""Execute all runs concurrently with at most nconcurrent in flight"""
+
+	semaphore = asyncio.Semaphore(driverData['nconcurrent'])
+	pending = set()
+
+	for run in runs:
+		await semaphore.acquire()
+		task = asyncio.ensure_future(asyncWorker(run))
+		task.add_done_callback(lambda t: semaphore.release())
+		task.add_done_callback(lambda t: reportCompletion(t.result()))
+		pending.add(task)
+		task.add_done_callback(pending.discard)
+
+	if(pending):
+		await asyncio.gather(*pending)
+
+#============================================
+# Static sharding: split the runs of all run*
+# sections between N independent invocations
+# (e.g. the tasks of a job array), without any
+# coordination between them. Runs are numbered
+# globally in section order, and each shard
+# computes its own slice by indexing directly
+# into the mixed-radix run spaces:
+#   roundrobin - shard K executes runs
+#                K, K+N, K+2N, ...
+#   weighted   - runs are split into N
+#                contiguous blocks of equal
+#                total cost, given by the
+#                optional 'cost' expression of
+#                each run section (default 1)
+#============================================
+def parseShard(shardStr):
+	"""Parse a K/N shard specification. K may be 'auto' to use the job array index"""
+
+	kStr, sep, nStr = shardStr.partition('/')
+	if(kStr == 'auto'):
+		for indexVar, minVar, countVar in SHARD_ENV:
+			if(indexVar in os.environ):
+				index = int(os.environ[indexVar])
+				if(minVar is not None):
+					k = index - int(os.environ.get(minVar, 0))
+					if(not nStr and countVar in os.environ):
+						nStr = os.environ[countVar]
+				else:
+					indices = pbsArrayIndices()
+					k = indices.index(index) if indices and index in indices else index
+					if(not nStr and indices):
+						nStr = str(len(indices))
+				break
+		else:
+			abort('No job array index found in the environment ({})'.format(', '.join(v[0] for v in SHARD_ENV)))
+	elif(kStr.isdigit()):
+		k = int(kStr)
+	else:
+		abort('Invalid shard "{}". Expected K/N or auto[/N]'.format(shardStr))
+
+	if(not nStr.isdigit() or int(nStr) < 1 or not 0 <= k < int(nStr)):
+		abort('Invalid shard "{}". Expected K/N with 0 <= K < N'.format(shardStr))
+	return k, int(nStr)
+
+def pbsArrayIndices():
+	"""Return the sorted indices of the current PBS job array, as reported by qstat, or None"""
+
+	# PBS Pro exports the array's id, Torque only the id of the array task
+	jobId = os.environ.get('PBS_ARRAY_ID') or re.sub(r'\[\d+\]', '[]', os.environ.get('PBS_JOBID', ''))
+	if('[]' not in jobId):
+		return None
+	try:
+		output = subprocess.run(['qstat', '-f', jobId], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+		                        universal_newlines=True, timeout=60).stdout
+	except (OSError, subprocess.SubprocessError):
+		return None
+	match = re.search(r'(?:array_indices_submitted|job_array_request)\s*=\s*([0-9,:-]+)', output)
+	if(match is None):
+		return None
+
+	# Ranges are given as e.g. "1-10", "0-9:2" or (with Torque) "1,3,5-7"
+	indices = set()
+	for part in match.group(1).split(','):
+		span, _sep, step = part.partition(':')
+		first, _sep, last = span.partition('-')
+		if(first):
+			indices.update(range(int(first), int(last or first)+1, int(step or 1)))
+	return sorted(indices)
+
+def sectionCost(section):
+	"""Return the constant cost of the runs of a section, or None if it varies per run"""
+
+	cost = runData[section].get('cost', 1)
+	if(isinstance(cost,str)):
+		scopes = parameterScopes(section)
+		if(any(scopes.get(dep, SCOPE_DYNAMIC) > SCOPE_SECTION for dep in parameterDependencies(cost))):
+			return None
+		cost = evaluateStr(interpolateString(cost, runSpaces[section].build(runSpaces[section].index(0))))
+	if(float(cost) < 0):
+		abort('Negative cost {} for run section {}'.format(cost, section))
+	return float(cost)
+
+def runCost(section, idx):
+	"""Evaluate the cost expression of a single run"""
+
+	data = runSpaces[section].build(idx)
+	cost = float(evaluateStr(interpolateString(runData[section]['cost'], data)))
+	if(cost < 0):
+		abort('Negative cost {} for run {}{}'.format(cost, section, list(idx)))
+	return cost
+
+def sectionRunCosts(section):
+	"""Evaluate the cost expression of all runs of a section at once"""
+
+	runs = [(section, idx) for idx in runSpaces[section].indices()]
+	costs = evaluateRuns('cost', runs)
+	for run, cost in zip(runs, costs):
+		if(cost < 0):
+			abort('Negative cost {} for run {}{}'.format(cost, run[0], list(run[1])))
+	return costs
+
+def shardRuns(k, n, mode='roundrobin'):
+	"""Lazily yield the (section, index tuple) pairs of shard k out of n"""
+
+	if(mode == 'roundrobin'):
+		offset = 0
+		for space in runSpaces.values():
+			for i in range((k-offset) % n, len(space), n):
+				yield (space.section, space.index(i))
+			offset += len(space)
+		return
+
+	# Total cost, evaluating per-run costs only for sections where they vary.
+	# Vectorized costs are kept, others are evaluated again when assigning runs
+	costs = OrderedDict((key, sectionCost(key)) for key in runSpaces if len(runSpaces[key]))
+	runCosts = dict()
+	total = 0.0
+	for key, cost in costs.items():
+		if(cost is not None):
+			total += cost*len(runSpaces[key])
+		elif(driverData['vectorize']):
+			runCosts[key] = sectionRunCosts(key)
+			total += sum(runCosts[key])
+		else:
+			total += sum(runCost(key, idx) for idx in runSpaces[key].indices())
+	if(total <= 0):
+		for run in shardRuns(k, n):
+			yield run
+		return
+
+	def shardOf(midpoint):
+		return min(n-1, int(n*midpoint/total))
+
+	base = 0.0
+	for key, cost in costs.items():
+		space = runSpaces[key]
+		if(cost is not None):
+			# Shards are monotonic in the run index: bisect for the first and last run of shard k
+			def firstOf(shard):
+				lo, hi = 0, len(space)
+				while(lo < hi):
+					mid = (lo+hi)//2
+					if(shardOf(base + cost*(mid+0.5)) < shard):
+						lo = mid+1
+					else:
+						hi = mid
+				return lo
+			for i in range(firstOf(k), firstOf(k+1)):
+				yield (key, space.index(i))
+			base += cost*len(space)
+		else:
+			for i, idx in enumerate(space.indices()):
+				c = runCosts[key][i] if key in runCosts else runCost(key, idx)
+				if(shardOf(base + 0.5*c) == k):
+					yield (key, idx)
+				base += c
+
+#============================================
+# Dispatch order: by default runs are executed
+# in section and variable order. If any run
+# section defines a 'priority' expression, or a
+# runtime history is available, runs are
+# instead executed by descending priority, then
+# by descending expected runtime (so that long
+# runs do not trail at the end of the sweep),
+# and otherwise in their original order. This
+# requires all runs to be enumerated up front.
+#============================================
+def orderRuns(runs):
+	"""Order runs by priority and expected runtime, if either is available"""
+
+	priorities = any('priority' in runData[key] for key in runData)
+	predict = history is not None and history.mean is not None
+	if(not priorities and not predict):
+		return runs
+
+	runs = list(runs)
+	values = evaluateRuns('priority', runs) if priorities else [0.0]*len(runs)
+	keyed = []
+	for run, priority in zip(runs, values):
+		keyed.append((priority, history.predict(*run) if predict else 0.0, run))
+	keyed.sort(key=lambda k: (-k[0], -k[1]))
+	if(predict and keyed):
+		logInfo('Ordered {:d} runs by expected runtime ({:.1f}s expected in total)'.format(len(keyed), sum(k[1] for k in keyed)))
+	return iter([k[2] for k in keyed])
+
+#============================================
+# RunDependencies: a run section may depend on
+# other run sections ('depends_on'). Each of its
+# runs depends on the runs of the upstream
+# section with the same values of the variables
+# both sections share (or on all of them, if
+# they share none), and is only queued once all
+# of those have finished, rather than after the
+# whole upstream section. Upstream runs which
+# are not part of the sweep (e.g. of another
+# shard) are taken to be finished. If an
+# upstream run fails, its dependents are not
+# executed and are reported as 'blocked'.
+#============================================
+class RunDependencies(object):
+	"""Releases runs of dependent run sections as their upstream runs finish"""
+
+	def __init__(self, runs):
+		self.runs       = list(runs)
+		self.lock       = threading.Lock()
+		self.ready      = queue.Queue()
+		self.downstream = dict()
+		self.shared     = dict()
+		for section in runData:
+			for upstream in runData[section]['depends_on']:
+				self.downstream.setdefault(upstream, []).append(section)
+				self.shared[(section, upstream)] = sorted(set(runSpaces[section].order) & set(runSpaces[upstream].order))
+
+		# Number of unfinished upstream runs, by (section, upstream section, shared values)
+		self.pending = dict()
+		for section, idx in self.runs:
+			for downstream in self.downstream.get(section, []):
+				group = self.group(downstream, section, section, idx)
+				self.pending[group] = self.pending.get(group, 0)+1
+		self.failed    = set()
+		self.waiting   = dict()
+		self.blockers  = dict()
+		self.parked    = 0
+		self.submitted = False
+		self.done      = False
+
+	def group(self, section, upstream, runSection, idx):
+		"""Key of the runs of upstream which the runs of section with the same key depend on"""
+
+		space = runSpaces[runSection]
+		values = dict((v, vals[i]) for v, vals, i in zip(space.order, space.values, idx))
+		return (section, upstream, tuple(json.dumps(values[v], sort_keys=True, default=str) for v in self.shared[(section, upstream)]))
+
+	def submit(self, run):
+		"""Return whether a run is ready, or park it until its upstream runs have finished"""
 
-			# Perform postprocessing commands
-			if(driverData['precommand'] is not None):
-				precommand = interpolateString(driverData['precommand'],data)
-				cmdStr = 'cd %s && %s'%(workDir,interpolateString(precommand))
-				logInfo('Executing pre command: {}'.format(precommand))
-				proc = subprocess.Popen(cmdStr, shell=True)
-				proc.wait()
+		section, idx = run
+		with self.lock:
+			nWaiting = 0
+			blocked = False
+			for upstream in runData[section]['depends_on']:
+				group = self.group(section, upstream, section, idx)
+				if(self.pending.get(group, 0) > 0):
+					nWaiting += 1
+					self.waiting.setdefault(group, []).append(run)
+				blocked = blocked or group in self.failed
+			if(nWaiting == 0):
+				if(blocked):
+					self.block(run)
+				return not blocked
+			self.blockers[run] = [nWaiting, blocked]
+			self.parked += 1
+			return False
 
-			# Run executable in working directory
-			if(driverData['execcommand'] is not None):
-				execcommand = interpolateString(driverData['execcommand'],data)
-				cmdStr = 'cd %s && %s'%(workDir,interpolateString(execcommand))
-				logInfo('Executing exec command: {}'.format(execcommand))
-				proc = subprocess.Popen(cmdStr, shell=True)
-				proc.wait()
+	def finish(self, result):
+		"""Record a finished run, releasing (or blocking) the runs waiting for it"""
 
-			# Perform postprocessing commands
-			if(driverData['postcommand'] is not None):
-				postcommand = interpolateString(driverData['postcommand'],data)
-				cmdStr = 'cd %s && %s'%(workDir,postcommand)
-				logInfo('Executing post command: {}'.format(postcommand))
-				proc = subprocess.Popen(cmdStr, shell=True)
-				proc.wait()
+		with self.lock:
+			self.release(result.section, result.idx, result.status != 'failed')
 
+	def release(self, section, idx, succeeded):
+		finished = [(section, idx, succeeded)]
+		while(finished):
+			section, idx, succeeded = finished.pop()
+			for downstream in self.downstream.get(section, []):
+				group = self.group(downstream, section, section, idx)
+				if(not succeeded):
+					self.failed.add(group)
+				self.pending[group] -= 1
+				if(self.pending[group] > 0):
+					continue
+				for run in self.waiting.pop(group, []):
+					blocker = self.blockers[run]
+					blocker[0] -= 1
+					blocker[1] = blocker[1] or group in self.failed
+					if(blocker[0] > 0):
+						continue
+					del self.blockers[run]
+					self.parked -= 1
+					if(blocker[1]):
+						completions.put(self.blockedResult(run))
+						finished.append(run+(False,))
+					else:
+						self.ready.put(run)
+		self.checkDone()
+
+	def block(self, run):
+		"""Report a run whose upstream runs failed, and block its own dependents"""
+
+		completions.put(self.blockedResult(run))
+		self.release(run[0], run[1], False)
+
+	@staticmethod
+	def blockedResult(run):
+		return finishRun(None, RunResult(run[0], run[1], None, 'blocked', [], {'start': time.time()}))
+
+	def checkDone(self):
+		if(self.submitted and self.parked == 0 and not self.done):
+			self.done = True
+			self.ready.put(None)
+
+	def readyRuns(self):
+		"""Yield runs as soon as the runs they depend on have finished"""
+
+		for run in self.runs:
+			if(self.submit(run)):
+				yield run
+		with self.lock:
+			self.submitted = True
+			self.checkDone()
+		while(True):
+			run = self.ready.get()
+			if(run is None):
+				return
+			yield run
+
+#============================================
+# Distributed execution: a coordinator
+# (--serve) owns the run space and hands runs
+# out over plain TCP connections to worker
+# processes (--worker), which execute them with
+# executeRun and report the results back.
+# Messages are newline-delimited JSON objects
+# with an "op" field:
+#   worker -> coordinator
+#     {"op": "config"}   request configuration
+#     {"op": "next"}     request a run
+#     {"op": "result", ...RunResult fields}
+#   coordinator -> worker
+#     {"op": "config", "cfg": ..., "cwd": ...}
+#     {"op": "run", "section": ..., "idx": [...]}
+#     {"op": "done"}     no runs are left
+# Each worker thread holds its own connection
+# and at most one run. If a connection is lost,
+# its run is requeued. Workers may join and
+# leave at any time during the sweep.
+#============================================
+def sendMessage(wfile, msg):
+	"""Write a single message to a connection"""
+	wfile.write(json.dumps(msg, default=str).encode('utf-8')+b'\n')
+	wfile.flush()
+
+def receiveMessage(rfile):
+	"""Read a single message from a connection, or None if it was closed"""
+	line = rfile.readline()
+	if(not line):
+		return None
+	return json.loads(line.decode('utf-8'))
+
+def parseAddress(address, defaultHost=None):
+	"""Split a HOST:PORT (or PORT, if defaultHost is given) string"""
+
+	host, sep, port = address.rpartition(':')
+	if(not sep):
+		host = defaultHost
+	if(not host or not port.isdigit()):
+		abort('Invalid address "{}". Expected HOST:PORT'.format(address))
+	return host, int(port)
+
+class Coordinator(object):
+	"""Hands out runs to remote workers and collects their results"""
+
+	def __init__(self, cfg, runs):
+		self.cfg         = cfg
+		self.runs        = iter(runs)
+		self.exhausted   = False
+		self.finished    = False
+		self.requeued    = deque()
+		self.outstanding = dict()
+		self.nRequeues   = dict()
+		self.created     = dict()
+		self.cond        = threading.Condition()
+
+	def checkFinished(self):
+		"""Signal the end of the sweep once every run has been completed (lock held)"""
+		if(self.exhausted and not self.requeued and not self.outstanding and not self.finished):
+			self.finished = True
+			completions.put(None)
+			self.cond.notify_all()
+
+	def next(self, token):
+		"""Return the next run for a worker connection and whether its work directory is stale, or None if the sweep is finished"""
+
+		with self.cond:
+			while(True):
+				if(self.finished):
+					return None
+				if(self.requeued):
+					run = self.requeued.popleft()
+				elif(not self.exhausted):
+					try:
+						run = next(self.runs)
+					except StopIteration:
+						self.exhausted = True
+						self.checkFinished()
+						continue
+				else:
+					# Wait for outstanding runs, which may still be requeued
+					self.cond.wait()
+					continue
+
+				section, idx = run
+				data = runSpaces[section].build(idx)
+				workDir = resolveAbsPath(interpolateString(driverData['rundir'],data))
+				key = None
+				if(ledger is not None):
+					key = runKey(data)
+					if(key in ledger.done):
+						logDebug('Run %s%s already succeeded according to ledger. Skipping this run.', section, list(idx))
+						completions.put(RunResult(section, idx, None, 'skipped', [], {'start': time.time()}))
+						continue
+					ledger.start(key, section, idx, workDir)
+
+				# A requeued run may find the partial work directory of the worker which lost it
+				if(run not in self.created):
+					self.created[run] = not os.path.exists(workDir)
+				self.outstanding[token] = (run, key)
+				return run, self.nRequeues.get(run, 0) > 0 and self.created[run]
+
+	def complete(self, token, msg):
+		"""Record the result reported by a worker connection"""
+
+		with self.cond:
+			run, key = self.outstanding.pop(token)
+			self.created.pop(run, None)
+			result = RunResult(run[0], run[1], msg['workDir'], msg['status'],
+			                   [tuple(rc) for rc in msg['returncodes']], msg['phases'])
+			recordLedger(key, result)
+			completions.put(result)
+			self.checkFinished()
+
+	def release(self, token):
+		"""Requeue the run held by a connection which was closed"""
+
+		with self.cond:
+			if(token not in self.outstanding):
+				return
+			run, key = self.outstanding.pop(token)
+			self.nRequeues[run] = self.nRequeues.get(run, 0) + 1
+			if(self.nRequeues[run] > MAX_REQUEUES):
+				logInfo('Run {}{} lost by {:d} workers. Marking it failed.'.format(run[0], list(run[1]), MAX_REQUEUES+1))
+				self.created.pop(run, None)
+				result = RunResult(run[0], run[1], None, 'failed', [], {'start': time.time()})
+				recordLedger(key, result)
+				completions.put(result)
+			else:
+				logInfo('Worker connection lost. Requeueing run {}{}'.format(run[0], list(run[1])))
+				self.requeued.append(run)
+			self.cond.notify_all()
+			self.checkFinished()
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+	"""Serves a single worker connection"""
+
+	def handle(self):
+		self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		coordinator = self.server.coordinator
+		token = object()
+		try:
+			while(True):
+				msg = receiveMessage(self.rfile)
+				if(msg is None):
+					return
+				if(msg['op'] == 'config'):
+					sendMessage(self.wfile, {'op': 'config', 'cfg': coordinator.cfg, 'cwd': driverData['cwd']})
+				elif(msg['op'] == 'next'):
+					item = coordinator.next(token)
+					if(item is None):
+						sendMessage(self.wfile, {'op': 'done'})
+						return
+					run, stale = item
+					sendMessage(self.wfile, {'op': 'run', 'section': run[0], 'idx': list(run[1]), 'stale': stale})
+				elif(msg['op'] == 'result'):
+					coordinator.complete(token, msg)
+		except (OSError, ValueError) as e:
+			logInfo('Worker connection {} failed: {}'.format(self.client_address, e))
+		finally:
+			coordinator.release(token)
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads      = True
+
+#============================================
+# serveRuns: Run the coordinator until every
+# run has been completed by remote workers
+#============================================
+def serveRuns(address, cfg, runs):
+	"""Coordinate a sweep executed by remote workers"""
+
+	host, port = parseAddress(address, SERVE_HOST)
+	server = CoordinatorServer((host, port), CoordinatorHandler)
+	server.coordinator = Coordinator(cfg, runs)
+	logInfo('Coordinator listening on {}:{:d}'.format(*server.server_address[:2]))
+
+	serverThread = threading.Thread(target=server.serve_forever, name='server')
+	serverThread.daemon = True
+	serverThread.start()
+
+	collectCompletions(1)
+
+	server.shutdown()
+	server.server_close()
+
+#============================================
+# remoteWorker: Worker thread connected to a
+# coordinator. Pulls runs and executes them
+# until the coordinator has no runs left. The
+# partial work directory of a requeued run,
+# created by the worker which lost it, is
+# removed before the run is executed again.
+#============================================
+def remoteWorker(host, port):
+	"""Execute runs handed out by a coordinator"""
+
+	sock = socket.create_connection((host, port))
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+	rfile = sock.makefile('rb')
+	wfile = sock.makefile('wb')
+	try:
+		while(True):
+			sendMessage(wfile, {'op': 'next'})
+			msg = receiveMessage(rfile)
+			if(msg is None or msg['op'] == 'done'):
+				return
+
+			run = (msg['section'], tuple(msg['idx']))
+			try:
+				if(msg.get('stale')):
+					data = runSpaces[run[0]].build(run[1])
+					removeIncompleteRun(resolveAbsPath(interpolateString(driverData['rundir'],data)))
+				result = executeRun(run)
+			except (Exception, SystemExit):
+				result = crashedResult(run)
+			sendMessage(wfile, dict(result._asdict(), op='result'))
+	finally:
+		sock.close()
+
+#============================================
+# runRemoteWorker: Join a sweep served by a
+# coordinator. The configuration is retrieved
+# from the coordinator, and nthreads worker
+# threads are started, each with its own
+# connection.
+#============================================
+def runRemoteWorker(address):
+	"""Retrieve the configuration from a coordinator and execute its runs"""
+
+	host, port = parseAddress(address)
+	sock = socket.create_connection((host, port))
+	rfile = sock.makefile('rb')
+	wfile = sock.makefile('wb')
+	sendMessage(wfile, {'op': 'config'})
+	msg = receiveMessage(rfile)
+	sock.close()
+	if(msg is None):
+		abort('Coordinator {} closed the connection'.format(address))
+
+	# Paths are resolved relative to the coordinator's working directory
+	if(os.path.isdir(msg['cwd'])):
+		os.chdir(msg['cwd'])
+	initConfig(msg['cfg'])
+	driverData['cwd'] = msg['cwd']
+	foldParameters()
+	initResultCache()
+
+	logInfo('Joined coordinator {} with {:d} threads'.format(address, driverData['nthreads']))
+	threads = [ threading.Thread(target=remoteWorker, args=(host, port), name='{:02d}'.format(_i)) for _i in range(driverData['nthreads']) ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
 
 #============================================
 # setupParser: Setup command line argument parser
@@ -553,6 +4397,21 @@ def setupParser():
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-i','--input',default='input.yaml',help='specify input YAML file')
+	parser.add_argument('-v','--verbose',action='count',default=0,help='also log the details of every run')
+	parser.add_argument('-q','--quiet',action='count',default=0,help='only log warnings and errors')
+	parser.add_argument('--events',default=None,help='write log records as JSON objects, one per line, to EVENTS')
+	parser.add_argument('--trace',default=None,help='write a JSONL trace of per-run phase timings to TRACE')
+	parser.add_argument('--profile',action='store_true',help='summarize per-phase timings and the slowest runs at exit')
+	parser.add_argument('--shard',default=os.environ.get('CHAUFFEUR_SHARD'),metavar='K/N',
+	                    help='only execute shard K (0 <= K < N) of the runs; K may be "auto" to use the job array index')
+	parser.add_argument('--shard-mode',default='roundrobin',choices=['roundrobin','weighted'],
+	                    help='assign runs to shards round-robin, or in contiguous blocks of equal cost')
+	parser.add_argument('--serve',default=None,metavar='[HOST:]PORT',help='coordinate the sweep for remote workers, listening on HOST:PORT')
+	parser.add_argument('--worker',default=None,metavar='HOST:PORT',help='execute runs handed out by the coordinator at HOST:PORT')
+	parser.add_argument('--manifest',default=None,help='execute the run scripts listed in MANIFEST (or its --shard) concurrently')
+	parser.add_argument('--cache-info',action='store_true',help='show the size and use of the result cache, then exit')
+	parser.add_argument('--cache-prune',default=None,type=float,metavar='MB',
+	                    help='evict least recently used entries until the result cache holds at most MB, then exit')
 	return parser
 
 #============================================
@@ -563,55 +4422,134 @@ if(__name__ == "__main__"):
 	# Parser arguments and read YAML configuration file
 	parser = setupParser();
 	args = parser.parse_args()
+	setupLogging(args.verbose-args.quiet, args.events)
+	initSignals()
+
+	if(args.worker is not None):
+		runRemoteWorker(args.worker)
+		sys.exit(0)
+
+	if(args.manifest is not None):
+		sys.exit(1 if runManifest(args.manifest, args.shard) else 0)
 
 	with open(args.input,'r') as f:
 		cfg = yaml.safe_load(f)
 
-		# Initialize driver configuration
-		initDriverData(cfg)
-		# Initialize user configuration
-		initUserData(cfg)
-		# Initialize file configurations
-		initFileData(cfg)
-		# Initialize run configurations
-		initRunData(cfg)
-
-	# Construct cartesian product of variables for each run
-	runs = []
-	for r in runData.keys():
-		tmp = generateProduct(runData[r]['variables'],runData[r]['variableorder'])
-
-		# Append run parameters to each of the generated subruns
-		if('parameters' in runData[r].keys()):
-			for i in range(0,len(tmp)):
-				tmp[i].update(runData[r]['parameters'])
-
-		runs.extend(tmp)
-		# runs.extend(generateProduct(runData[r]['variables'],runData[r]['variableorder']))
-
-	runqueue = queue.Queue()
-	for r in runs:
-		logInfo('Adding run info {}'.format(r))
-		runqueue.put(r)
-
-	threads = [ threading.Thread(target=worker, name='{:02d}'.format(_i)) for _i in range(driverData['nthreads']) ]
-	for thread in threads:
-		thread.daemon = True
-		logInfo('Starting thread')
-		thread.start()
-		runqueue.put(None)  # one EOF marker for each thread
+	# Initialize driver, user, file and run configurations
+	initConfig(cfg)
+
+	# Inspecting or pruning the result cache exits before the ledger is
+	# opened, which would mark the runs of a live sweep as interrupted
+	initResultCache()
+	if(args.cache_info or args.cache_prune is not None):
+		if(resultCache is None):
+			abort('No result cache is configured (driver parameter "cache")')
+		if(args.cache_prune is not None):
+			logInfo('Evicted {:d} entries from result cache'.format(resultCache.prune(int(args.cache_prune*1024*1024))))
+		nEntries, nBytes, oldest, newest = resultCache.info()
+		logInfo('Result cache {}: {:d} entries, {:.1f} of {:.1f} MB'.format(resultCache.path, nEntries,
+			nBytes/2.0**20, resultCache.maxBytes/2.0**20))
+		if(nEntries):
+			logInfo('Least recently used {}, most recently used {}'.format(time.ctime(oldest), time.ctime(newest)))
+		resultCache.close()
+		sys.exit(0)
+
+	# Open the run ledger used to resume interrupted sweeps, and the
+	# history of runtimes used to order runs
+	initLedger()
+	initHistory()
+
+	# Set up per-run tracing
+	if(args.trace is not None or args.profile):
+		tracer = RunTracer(args.trace, args.profile)
 
+	# Collect per-run results as runs finish
+	initCollector()
+
+	# Select the runs to execute
+	runs = generateRuns()
+	if(args.shard is not None):
+		shardK, shardN = parseShard(args.shard)
+		logInfo('Executing shard {:d}/{:d} ({})'.format(shardK, shardN, args.shard_mode))
+		runs = shardRuns(shardK, shardN, args.shard_mode)
+	runs = orderRuns(runs)
+
+	if(args.serve is not None):
+		# Hand runs out to remote workers
+		if(any(runData[key]['depends_on'] for key in runData)):
+			abort('depends_on is not supported with --serve')
+		serveRuns(args.serve, cfg, runs)
+	elif(driverData['engine'] == 'asyncio'):
+		# Execute all runs from a single event loop
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		loop.run_until_complete(runAsyncEngine(runs))
+		loop.close()
+	else:
+		# Runs are streamed through a bounded queue as threads consume them.
+		# With a scheduler, runs are only queued once their resources are
+		# available, and there is a thread for each core.
+		nthreads = driverData['nthreads']
+		feed = feedRuns
+		if(any(runData[key]['depends_on'] for key in runData)):
+			dependencies = RunDependencies(runs)
+			runs = dependencies.readyRuns()
+		if(driverData['speculate'] is not None):
+			speculator = Speculator(driverData['speculate'])
+		if(driverData['scheduler'] is not None):
+			initResourcePool()
+			nthreads = resourcePool.cores
+			feed = scheduleRuns
+
+		if(driverData['pipeline'] is not None):
+			# Each stage has its own threads, fed by the run queue of the setup stage
+			pipeline = Pipeline(driverData['pipeline'])
+			runqueue = pipeline.queues[0]
+			threads = pipeline.threads
+			nFeeds, nProducers = pipeline.limits[0], pipeline.limits[-1]
+		else:
+			runqueue = queue.Queue(maxsize=RUN_QUEUE_DEPTH*nthreads)
+			threads = [ threading.Thread(target=worker, name='{:02d}'.format(_i)) for _i in range(nthreads) ]
+			for thread in threads:
+				thread.daemon = True
+				logDebug('Starting thread')
+				thread.start()
+			nFeeds = nProducers = nthreads
+
+		feeder = threading.Thread(target=feed, args=(runs, nFeeds), name='feeder')
+		feeder.daemon = True
+		feeder.start()
+
+		# Report runs as they complete, until every thread has exited
+		collectCompletions(nProducers)
 
-	# Keep master thread alive and check to see if all threads are done
-	while True:
-		time.sleep(1)
-		stillRunning = False
 		for thread in threads:
-			if thread.isAlive():
-				stillRunning = True
+			thread.join()
 
-		if(not stillRunning):
-			break
+	logInfo('Sweep complete: {}'.format(', '.join('{:d} {}'.format(n, status) for status, n in sorted(runSummary.items()))),
+	        extra={'fields': {'event': 'sweep', 'summary': runSummary}})
+	for section, idx, workDir, tails in failedRuns:
+		logInfo('Failed run {}{} ({})'.format(section, idx, workDir))
+		for phase, tail in tails:
+			logInfo('  Last output of {} command:\n{}'.format(phase, tail.rstrip('\n')))
+	if(runSummary.get('failed', 0) > len(failedRuns)):
+		logInfo('{:d} further runs failed'.format(runSummary['failed']-len(failedRuns)))
+	if(fileData):
+		logInfo('Generated files: {:d} written, {:d} unchanged'.format(fileStats['written'], fileStats['unchanged']))
+	if(ledger is not None):
+		ledger.close()
+	if(tracer is not None):
+		tracer.close()
+	if(history is not None):
+		history.close()
+	if(resultCache is not None):
+		resultCache.close()
+	if(pythonPool is not None):
+		pythonPool.shutdown()
+	if(collector is not None):
+		collector.close()
+	if(feedFailed):
+		sys.exit(1)
 
 	# Construct PBS submission script
 	constructPbsSubmitScript()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+## Tests of the coordinator/worker mode (--serve / --worker).
+##
+## A coordinator and its workers are started as separate chauffeur processes
+## on localhost, executing a small sweep in a temporary directory.
+
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+
+testDir   = os.path.dirname(os.path.realpath(__file__))
+scriptDir = os.path.dirname(testDir)
+chauffeur = os.path.join(scriptDir, 'chauffeur.py')
+
+TIMEOUT = 60
+
+COMMAND = 'touch started && sleep {sleep} && echo %(a) > out.txt'
+
+CONFIG = '''driver:
+  rundir: "%(cwd)/runs/r%(a)"
+  execcommand: "{command}"
+  nthreads: {nthreads}
+  dryrun: False
+{extra}
+run:
+  variables:
+    a: [1, 2, 3, 4, 5, 6]
+'''
+
+#============================================
+# Helpers
+#============================================
+def freePort():
+	"""Return a TCP port which is currently free on localhost"""
+
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def start(args, cwd, log):
+	"""Start chauffeur with args in cwd, in a session of its own, logging to log"""
+
+	return subprocess.Popen([sys.executable, chauffeur]+args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+	                        start_new_session=True)
+
+def waitFor(condition, what):
+	"""Wait for condition() to become true"""
+
+	deadline = time.time()+TIMEOUT
+	while(not condition()):
+		assert time.time() < deadline, 'Timed out waiting for '+what
+		time.sleep(0.1)
+
+def readLog(path):
+	with open(path) as f:
+		return f.read()
+
+def startCoordinator(tmp_path, sleep, nthreads, extra='', command=COMMAND):
+	"""Write the configuration and start a coordinator, returning (process, address, logPath)"""
+
+	config = CONFIG.format(command=command.format(sleep=sleep), nthreads=nthreads, extra=extra)
+	(tmp_path / 'input.yaml').write_text(config)
+	address = '127.0.0.1:{:d}'.format(freePort())
+	logPath = str(tmp_path / 'coordinator.log')
+	coordinator = start(['-i', 'input.yaml', '--serve', address], str(tmp_path), open(logPath, 'w'))
+	waitFor(lambda: 'Coordinator listening' in readLog(logPath) or coordinator.poll() is not None,
+	        'the coordinator to listen')
+	assert coordinator.poll() is None, readLog(logPath)
+	return coordinator, address, logPath
+
+def checkOutputs(tmp_path):
+	for a in range(1, 7):
+		assert (tmp_path / 'runs' / 'r{:d}'.format(a) / 'out.txt').read_text() == '{:d}\n'.format(a)
+
+def stop(procs):
+	for proc in procs:
+		if(proc.poll() is None):
+			os.killpg(proc.pid, signal.SIGKILL)
+			proc.wait()
+
+#============================================
+# Tests
+#============================================
+def test_two_workers(tmp_path):
+	"""Two workers share the runs of a coordinator"""
+
+	coordinator, address, logPath = startCoordinator(tmp_path, 0.2, 2)
+	workers = [start(['--worker', address], str(tmp_path), open(str(tmp_path / 'worker{:d}.log'.format(i)), 'w'))
+	           for i in range(2)]
+	try:
+		assert coordinator.wait(TIMEOUT) == 0
+		for worker in workers:
+			assert worker.wait(TIMEOUT) == 0
+	finally:
+		stop([coordinator]+workers)
+
+	assert 'Sweep complete: 6 succeeded' in readLog(logPath)
+	checkOutputs(tmp_path)
+	for i in range(2):
+		assert 'Joined coordinator' in readLog(str(tmp_path / 'worker{:d}.log'.format(i)))
+
+def test_aborted_run(tmp_path):
+	"""A run which aborts on a worker is reported to the coordinator as failed"""
+
+	coordinator, address, logPath = startCoordinator(tmp_path, 0, 2, command='echo %(undefinedparam)')
+	worker = start(['--worker', address], str(tmp_path), open(str(tmp_path / 'worker.log'), 'w'))
+	try:
+		assert coordinator.wait(TIMEOUT) == 0
+		assert worker.wait(TIMEOUT) == 0
+	finally:
+		stop([coordinator, worker])
+
+	assert 'Sweep complete: 6 failed' in readLog(logPath)
+	assert 'Unable to fully resolve' in readLog(str(tmp_path / 'worker.log'))
+
+def requeueLostRun(tmp_path, extra=''):
+	"""Kill the worker executing the first run, and complete the sweep with another worker"""
+
+	coordinator, address, logPath = startCoordinator(tmp_path, 1, 1, extra)
+	lost = start(['--worker', address], str(tmp_path), open(str(tmp_path / 'lost.log'), 'w'))
+	workers = [lost]
+	try:
+		# Kill the first worker (and the command it runs) once its run has started
+		runsDir = tmp_path / 'runs'
+		waitFor(lambda: runsDir.is_dir() and any((d / 'started').exists() for d in runsDir.iterdir()),
+		        'the first run to start')
+		os.killpg(lost.pid, signal.SIGKILL)
+		lost.wait()
+		waitFor(lambda: 'Requeueing run' in readLog(logPath), 'the run to be requeued')
+
+		workers.append(start(['--worker', address], str(tmp_path), open(str(tmp_path / 'worker.log'), 'w')))
+		assert coordinator.wait(TIMEOUT) == 0
+		assert workers[-1].wait(TIMEOUT) == 0
+	finally:
+		stop([coordinator]+workers)
+	return logPath
+
+def test_requeue_lost_run(tmp_path):
+	"""The run of a worker whose connection drops is requeued and executed by another worker"""
+
+	logPath = requeueLostRun(tmp_path)
+	assert 'Sweep complete: 6 succeeded' in readLog(logPath)
+	checkOutputs(tmp_path)
+
+def test_requeue_lost_run_templatedir(tmp_path):
+	"""The partial work directory of a requeued run is removed rather than skipped as existing"""
+
+	(tmp_path / 'template').mkdir()
+	(tmp_path / 'template' / 'input.txt').write_text('template\n')
+	logPath = requeueLostRun(tmp_path, '  templatedir: "%(cwd)/template"\n')
+	assert 'Sweep complete: 6 succeeded' in readLog(logPath)
+	checkOutputs(tmp_path)
+	assert 'Removing work directory' in readLog(str(tmp_path / 'worker.log'))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+## Tests of the submission of PBS runs as packed jobs and job arrays.
+##
+## The generated submission script is executed with a stub qsub, which runs
+## each job script in place (once per index of a job array) instead of
+## submitting it. The range of a job array is reported by a stub qstat.
+
+import os
+import sys
+import stat
+import subprocess
+
+testDir   = os.path.dirname(os.path.realpath(__file__))
+scriptDir = os.path.dirname(testDir)
+chauffeur = os.path.join(scriptDir, 'chauffeur.py')
+sys.path.insert(0, scriptDir)
+
+import chauffeur as driver
+
+TIMEOUT = 60
+
+STUB_QSUB = '''#!/bin/bash
+# Stub qsub: run the script once per array index, if any
+range=$(grep -o '^#PBS -J [0-9-]*' "$1" | awk '{{print $3}}')
+echo "$1 ${{range:-single}}" >> {log}
+if [ -n "$range" ]; then
+  for i in $(seq ${{range%-*}} ${{range#*-}}); do PBS_ARRAY_INDEX=$i bash "$1" || exit 1; done
+else
+  bash "$1"
+fi
+'''
+
+STUB_QSTAT = '''#!/bin/sh
+echo "Job Id: $2"
+echo "    {attribute} = {indices}"
+'''
+
+RUN_TEMPLATE = '''#!/bin/sh
+#PBS -N run_a%(a)
+#PBS -l nodes=%(nodes)
+
+cd $PBS_O_WORKDIR
+echo %(a) > out.txt
+'''
+
+CONFIG = '''driver:
+  rundir: "%(cwd)/rundirs/a%(a)"
+  type: setup
+  dryrun: False
+  pbs_subcommand: "{qsub}"
+  pbs_mode: {mode}
+  pbs_pack: 2
+
+file_pbs:
+  input: "run.sh_template"
+  output: "%(rundir)/run.sh"
+  type: "pbs"
+
+run_1:
+  variables:
+    a: [1, 2, 3]
+  parameters:
+    nodes: 1
+
+run_2:
+  variables:
+    a: [4]
+  parameters:
+    nodes: 2
+'''
+
+#============================================
+# Helpers
+#============================================
+def submitSweep(tmp_path, mode):
+	"""Set up the sweep with chauffeur and submit it with the stub qsub. Returns the qsub log"""
+
+	qsub = tmp_path / 'qsub'
+	log = tmp_path / 'qsub.log'
+	qsub.write_text(STUB_QSUB.format(log=log))
+	qsub.chmod(qsub.stat().st_mode | stat.S_IXUSR)
+	(tmp_path / 'run.sh_template').write_text(RUN_TEMPLATE)
+	(tmp_path / 'input.yaml').write_text(CONFIG.format(qsub=qsub, mode=mode))
+
+	subprocess.run([sys.executable, chauffeur, '-i', 'input.yaml'], cwd=str(tmp_path), check=True, timeout=TIMEOUT)
+	subprocess.run(['bash', 'pbs_submit.sh'], cwd=str(tmp_path), check=True, timeout=TIMEOUT)
+	return log.read_text().split('\n')[:-1]
+
+def arrayTask(tmp_path, monkeypatch, attribute, indices, env):
+	"""Set up the environment of a job array task, with a stub qstat reporting the array's indices"""
+
+	qstat = tmp_path / 'qstat'
+	qstat.write_text(STUB_QSTAT.format(attribute=attribute, indices=indices))
+	qstat.chmod(qstat.stat().st_mode | stat.S_IXUSR)
+	monkeypatch.setenv('PATH', str(tmp_path)+os.pathsep+os.environ['PATH'])
+	for indexVar, _minVar, _countVar in driver.SHARD_ENV:
+		monkeypatch.delenv(indexVar, raising=False)
+	monkeypatch.delenv('PBS_ARRAY_ID', raising=False)
+	monkeypatch.delenv('PBS_JOBID', raising=False)
+	for var, value in env.items():
+		monkeypatch.setenv(var, value)
+
+def checkOutputs(tmp_path):
+	for a in range(1, 5):
+		assert (tmp_path / 'rundirs' / 'a{:d}'.format(a) / 'out.txt').read_text() == '{:d}\n'.format(a)
+
+#============================================
+# Tests
+#============================================
+def test_packed_jobs(tmp_path):
+	"""Runs with the same resources are packed pbs_pack to a job"""
+
+	assert submitSweep(tmp_path, 'jobs') == ['pack_0_0.sh single', 'pack_0_1.sh single', 'pack_1_0.sh single']
+	checkOutputs(tmp_path)
+
+def test_job_arrays(tmp_path):
+	"""Each group of runs is submitted as a job array, unless it fits in a single job"""
+
+	assert submitSweep(tmp_path, 'array') == ['array_0.sh 0-1', 'pack_1_0.sh single']
+	checkOutputs(tmp_path)
+	with open(os.path.join(str(tmp_path), 'pbs_jobs', 'pack_1_0.sh')) as f:
+		assert '#PBS -J' not in f.read()
+
+def test_shard_auto_pbs(tmp_path, monkeypatch):
+	"""The index of a PBS Pro array task is counted from the first index of the array"""
+
+	arrayTask(tmp_path, monkeypatch, 'array_indices_submitted', '1-3',
+	          {'PBS_ARRAY_INDEX': '3', 'PBS_ARRAY_ID': '12[].server'})
+	assert driver.parseShard('auto/3') == (2, 3)
+	assert driver.parseShard('auto') == (2, 3)
+
+def test_shard_auto_torque(tmp_path, monkeypatch):
+	"""The index of a Torque array task is its position among the indices of the array"""
+
+	arrayTask(tmp_path, monkeypatch, 'job_array_request', '1,3,5-7',
+	          {'PBS_ARRAYID': '5', 'PBS_JOBID': '12[5].server'})
+	assert driver.parseShard('auto') == (2, 5)
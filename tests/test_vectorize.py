@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+## Tests of the vectorized evaluation of per-run expressions (vectorize).
+##
+## The priority and cost expressions of a sweep are evaluated with and
+## without vectorization, which must give the same order and shards.
+
+import os
+import sys
+
+import pytest
+
+testDir   = os.path.dirname(os.path.realpath(__file__))
+scriptDir = os.path.dirname(testDir)
+sys.path.insert(0, scriptDir)
+
+import chauffeur as driver
+
+pytest.importorskip('numpy')
+
+CONFIG = {
+	'driver':  {'execcommand': 'true', 'vectorize': False},
+	'userdef': {'scale': 3},
+	'run_1':   {'variables': {'a': [1, 2, 3, 4], 'b': [0.5, 2.0]},
+	            'priority': '`pow(%(a),2)*%(b)-%(scale)*%(a)`',
+	            'cost': '`sqrt(%(a))*%(b)`'},
+	'run_2':   {'variables': {'a': [5, 6, 7]},
+	            'priority': 4,
+	            'cost': '`%(a)//2`'},
+}
+
+#============================================
+# Helpers
+#============================================
+def configure(vectorize):
+	"""Initialize chauffeur from CONFIG, with or without vectorization"""
+
+	for d in (driver.driverData, driver.userData, driver.runData, driver.fileData, driver.collectData):
+		d.clear()
+	cfg = dict(CONFIG, driver=dict(CONFIG['driver'], vectorize=vectorize))
+	driver.initConfig(cfg)
+
+#============================================
+# Tests
+#============================================
+def test_evaluate_runs(monkeypatch):
+	"""Vectorized expressions give the values of the scalar path, without evaluating each run"""
+
+	configure(False)
+	runs = list(driver.generateRuns())
+	scalar = driver.evaluateRuns('priority', runs)
+	assert scalar[:2] == [1*1*0.5-3*1, 2*2*0.5-3*2]
+	assert scalar[-3:] == [4.0, 4.0, 4.0]
+
+	configure(True)
+	def evaluateStr(inStr):
+		raise AssertionError('Expression {} evaluated per run'.format(inStr))
+	monkeypatch.setattr(driver, 'evaluateStr', evaluateStr)
+	assert driver.evaluateRuns('priority', runs) == scalar
+
+def test_priority_order():
+	"""Runs are ordered by priority the same way with and without vectorization"""
+
+	configure(False)
+	scalar = list(driver.orderRuns(driver.generateRuns()))
+	configure(True)
+	assert list(driver.orderRuns(driver.generateRuns())) == scalar
+
+def test_weighted_shards():
+	"""Weighted shards are the same with and without vectorization"""
+
+	configure(False)
+	scalar = [list(driver.shardRuns(k, 3, 'weighted')) for k in range(3)]
+	configure(True)
+	assert [list(driver.shardRuns(k, 3, 'weighted')) for k in range(3)] == scalar
+	assert sorted(run for shard in scalar for run in shard) == sorted(driver.generateRuns())